@@ -36,6 +36,7 @@ NOTE: The code in this file runs on Python 2.7 and some NLTK functions may also
 ###       6.2. Extracting [N that V N N] phrases
 ###       6.3. Extracting the rhyme of a word
 ###       6.4. Poetry generation (using POS tags and bigrams)
+###       6.5. A streaming pipeline (tokenize, tag, extract, count)
 ### 7. Creating an NLTK-friendly corpus
 ###
 ################
@@ -46,15 +47,139 @@ import nltk, re
 ### 0. Downloading NLTK packages ###
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ###
 
-nltk.download()  # a window will pop up
+# nltk.download()  # a window will pop up
 
 ## for the purposes of this tutorial, download the following only:
 # brown
 # gutenberg
 # cmudict
 
+##-- Starting up without the window --##
+#
+#   - nltk.download() needs a screen (and someone to click), which a script
+#     on a server doesn't have
+#   - instead, we check which packages are already on this computer, without
+#     going online; the places where they were found are remembered in a small
+#     file, so the next session only has to check that they are still there
+#   - only the missing packages are downloaded, and only if we ask for it
+#     (nltk.download(name, quiet=True) doesn't open a window)
+
+import os, sys, time, subprocess
+from pickle import dump, load
+
+REQUIRED_PACKAGES = {'brown': 'corpora/brown',
+                     'gutenberg': 'corpora/gutenberg',
+                     'cmudict': 'corpora/cmudict'}
+PACKAGE_CACHE = os.path.join(os.path.expanduser('~'), '.nltk_packages.pkl')
+
+def find_packages(packages=REQUIRED_PACKAGES, cache_path=PACKAGE_CACHE):
+    # returns {name: where it is, or None if it's missing}
+    cached = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as input:
+            saved = load(input)
+        if saved.get('search_path') == nltk.data.path: # a different nltk_data means checking again
+            cached = saved['found']
+    found = {}
+    for name, resource in packages.items():
+        location = cached.get(name)
+        if location is None or not os.path.exists(location):
+            try:
+                pointer = nltk.data.find(resource)
+                location = getattr(pointer, 'path', None) or pointer.zipfile.filename
+            except LookupError:
+                location = None
+        found[name] = location
+    if found != dict((name, cached.get(name)) for name in packages):
+        with open(cache_path, 'wb') as output:
+            dump({'search_path': list(nltk.data.path), 'found': found}, output, -1)
+    return found
+
+def setup_packages(packages=REQUIRED_PACKAGES, download=False):
+    # returns the names of the packages that are still missing
+    found = find_packages(packages)
+    missing = sorted(name for name in found if found[name] is None)
+    if missing and download:
+        for name in missing:
+            nltk.download(name, quiet=True)
+        found = find_packages(packages)
+        missing = sorted(name for name in found if found[name] is None)
+    return missing
+
+# setup_packages()              # Returns: [] if everything is there
+# setup_packages(download=True) # fetches whatever is missing, without the window
+# (both remember what they found in PACKAGE_CACHE, a small file in your home folder)
+
+# The corpora themselves are not read yet: brown, gutenberg and cmudict below are
+# only placeholders, and each one is loaded the first time it is used.
+
 from nltk.corpus import brown, gutenberg, cmudict
 
+##-- Loading the rest only when it is needed --##
+#
+#   - the same goes for the things that take long to make: the t3 tagger
+#     (trained in 5.4 and stored in 5.5) and the cmudict dictionary
+#     (cmudict.dict() reads the whole file again every time it is called)
+#   - lazy() turns a function into one that does its work the first time it
+#     is called, and returns the same result after that
+
+def lazy(make):
+    result = []
+    def get():
+        if not result:
+            result.append(make())
+        return result[0]
+    return get
+
+def _load_t3(path='t3.pkl'):
+    with open(path, 'rb') as input:
+        return load(input)
+
+get_t3 = lazy(_load_t3)
+get_cmudict = lazy(cmudict.dict)
+
+# e.g. once t3.pkl exists (see 5.5), a new session can tag right away:
+# get_t3().tag(brown.sents()[0])
+# get_cmudict()['caravan']
+
+# NOTE: the modules imported further down (numpy, struct, mmap, multiprocessing)
+# are left at the top of their sections: NLTK already imports numpy and struct
+# itself, and mmap and multiprocessing add only a few milliseconds to the
+# 0.3-0.5 seconds that import nltk takes
+
+##-- How long until the first tagged sentence? --##
+#
+#   - measured in a brand new Python process (so nothing has been imported or
+#     loaded yet): import NLTK, load the stored t3, read the first sentence of
+#     brown and tag it
+#   - if this takes longer than the budget, something in the startup has
+#     become too slow
+
+COLD_START_BUDGET = 5.0 # seconds
+
+COLD_START = '''
+from pickle import load
+from nltk.corpus import brown
+with open(%r, 'rb') as input:
+    t3 = load(input)
+t3.tag(brown.sents()[0])
+'''
+
+def cold_start_time(tagger_path='t3.pkl'):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', COLD_START % tagger_path])
+    return time.time() - start
+
+def check_cold_start(tagger_path='t3.pkl', budget=COLD_START_BUDGET):
+    # returns True if the first tagged sentence came within the budget
+    seconds = cold_start_time(tagger_path)
+    if seconds > budget:
+        print('cold start took %.2f seconds (budget: %.2f)' % (seconds, budget))
+        return False
+    return True
+
+# check_cold_start() # True (once t3.pkl exists)
+
 
 ### ~~~~~~~~~~~~~~~ ###
 ### 1. NLTK Corpora ###
@@ -94,6 +219,201 @@ brown.tagged_sents()[0] # first sentence, each word tagged with part-of-speech i
 brown.tagged_words()[:50] # first fifty words, all tagged
 
 
+##-- An integer-encoded cache of a tagged corpus --##
+#
+#   - every call to brown.tagged_sents() or brown.tagged_words() reads and
+#     parses the corpus files again, and builds new tuples for every word
+#   - instead, we can go through a tagged corpus once and give every word and
+#     every tag an integer id; the corpus is then just a few arrays:
+#       word ids, tag ids, where each sentence starts, where each file starts
+#   - these arrays are saved with NumPy and memory-mapped when the cache is
+#     opened again, so nothing is parsed and nothing is copied; a sentence is
+#     only turned back into (word, tag) tuples when it is actually used
+#   - the cached corpus has the usual fileids(), categories(), words(), sents(),
+#     tagged_words() and tagged_sents() (by fileids or by categories)
+#   - requires NumPy (http://www.numpy.org)
+
+import numpy as np
+from array import array
+
+class EncodedTaggedCorpus(object):
+
+    def __init__(self, tagged_sents):
+        self.id2word, self.id2tag = [], []       # id -> word, id -> tag
+        self.word_index, self.tag_index = {}, {} # word -> id, tag -> id
+        word_ids, tag_ids, sent_offsets = array('i'), array('i'), array('i', [0])
+        for sent in tagged_sents:
+            for word, tag in sent:
+                word_ids.append(self._id(word, self.id2word, self.word_index))
+                tag_ids.append(self._id(tag, self.id2tag, self.tag_index))
+            sent_offsets.append(len(word_ids))
+        self.word_ids = np.frombuffer(word_ids, dtype=np.int32)
+        self.tag_ids = np.frombuffer(tag_ids, dtype=np.int32)
+        self.sent_offsets = np.frombuffer(sent_offsets, dtype=np.int32)
+
+    def _id(self, item, items, index):
+        i = index.get(item)
+        if i is None:
+            i = index[item] = len(items)
+            items.append(item)
+        return i
+
+    def tag_mask(self, tags):
+        # one True/False per tag id: is it one of these tags?
+        mask = np.zeros(len(self.id2tag), dtype=bool)
+        mask[[self.tag_index[t] for t in tags if t in self.tag_index]] = True
+        return mask
+
+    def pair_positions(self, first_tags, second_tags):
+        # positions i where tag i is in first_tags and tag i+1 is in second_tags,
+        # without crossing from one sentence into the next
+        tag_ids = self.tag_ids
+        pairs = self.tag_mask(first_tags)[tag_ids[:-1]] & self.tag_mask(second_tags)[tag_ids[1:]]
+        last = self.sent_offsets[1:-1] - 1 # the last word of every sentence
+        pairs[last[(last >= 0) & (last < len(pairs))]] = False
+        return np.flatnonzero(pairs)
+
+import os
+from pickle import dump, load
+import bisect
+
+CORPUS_CACHE_VERSION = 1
+
+def cache_tagged_corpus(corpus, path):
+    fileids = corpus.fileids()
+    file_offsets = array('i', [0]) # where each file starts, in sentences
+
+    def all_sents():
+        n = 0
+        for fileid in fileids:
+            for sent in corpus.tagged_sents(fileid):
+                n += 1
+                yield sent
+            file_offsets.append(n)
+
+    encoded = EncodedTaggedCorpus(all_sents())
+    if hasattr(corpus, 'categories'):
+        file_categories = [corpus.categories(fileid) for fileid in fileids]
+    else:
+        file_categories = [[] for fileid in fileids]
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'word_ids.npy'), encoded.word_ids)
+    np.save(os.path.join(path, 'tag_ids.npy'), encoded.tag_ids)
+    np.save(os.path.join(path, 'sent_offsets.npy'), encoded.sent_offsets)
+    np.save(os.path.join(path, 'file_offsets.npy'), np.frombuffer(file_offsets, dtype=np.int32))
+    with open(os.path.join(path, 'index.pkl'), 'wb') as output:
+        dump({'version': CORPUS_CACHE_VERSION, 'words': encoded.id2word, 'tags': encoded.id2tag,
+              'fileids': fileids, 'categories': file_categories}, output, -1)
+
+class _RangeView(object):
+    # a read-only list of items that are only decoded when they are used;
+    # ranges: [(start, end), ...] positions in the cache
+
+    def __init__(self, ranges, item):
+        self.ranges = [(start, end) for (start, end) in ranges if end > start]
+        self.item = item
+        self.starts = [0]
+        for start, end in self.ranges:
+            self.starts.append(self.starts[-1] + end - start)
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        r = bisect.bisect_right(self.starts, i) - 1
+        return self.item(self.ranges[r][0] + i - self.starts[r])
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            for i in range(start, end):
+                yield self.item(i)
+
+class CachedTaggedCorpus(EncodedTaggedCorpus):
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.pkl'), 'rb') as input:
+            index = load(input)
+        if index['version'] != CORPUS_CACHE_VERSION:
+            raise ValueError('%s is not a version %d corpus cache' % (path, CORPUS_CACHE_VERSION))
+        self.id2word, self.id2tag = index['words'], index['tags']
+        self.tag_index = dict((tag, i) for i, tag in enumerate(self.id2tag))
+        self._fileids, self._categories = index['fileids'], index['categories']
+        self._file_index = dict((fileid, i) for i, fileid in enumerate(self._fileids))
+        def mapped(name):
+            return np.load(os.path.join(path, name), mmap_mode='r')
+        self.word_ids = mapped('word_ids.npy')
+        self.tag_ids = mapped('tag_ids.npy')
+        self.sent_offsets = mapped('sent_offsets.npy')
+        self.file_offsets = mapped('file_offsets.npy')
+
+    def fileids(self, categories=None):
+        if categories is None:
+            return list(self._fileids)
+        if isinstance(categories, str):
+            categories = [categories]
+        return [fileid for fileid, cats in zip(self._fileids, self._categories)
+                if set(cats) & set(categories)]
+
+    def categories(self, fileids=None):
+        if fileids is None:
+            files = range(len(self._fileids))
+        else:
+            if isinstance(fileids, str):
+                fileids = [fileids]
+            files = [self._file_index[fileid] for fileid in fileids]
+        return sorted(set(cat for i in files for cat in self._categories[i]))
+
+    def _sent_ranges(self, fileids, categories):
+        if fileids is None and categories is None:
+            return [(0, len(self.sent_offsets) - 1)]
+        if fileids is None:
+            fileids = self.fileids(categories)
+        elif isinstance(fileids, str):
+            fileids = [fileids]
+        files = [self._file_index[fileid] for fileid in fileids]
+        return [(int(self.file_offsets[i]), int(self.file_offsets[i + 1])) for i in files]
+
+    def _word_ranges(self, fileids, categories):
+        return [(int(self.sent_offsets[lo]), int(self.sent_offsets[hi]))
+                for lo, hi in self._sent_ranges(fileids, categories)]
+
+    def _sent(self, i, tagged):
+        lo, hi = self.sent_offsets[i], self.sent_offsets[i + 1]
+        words = [self.id2word[w] for w in self.word_ids[lo:hi].tolist()]
+        if not tagged:
+            return words
+        return list(zip(words, [self.id2tag[t] for t in self.tag_ids[lo:hi].tolist()]))
+
+    def words(self, fileids=None, categories=None):
+        return _RangeView(self._word_ranges(fileids, categories),
+                          lambda i: self.id2word[self.word_ids[i]])
+
+    def tagged_words(self, fileids=None, categories=None):
+        return _RangeView(self._word_ranges(fileids, categories),
+                          lambda i: (self.id2word[self.word_ids[i]], self.id2tag[self.tag_ids[i]]))
+
+    def sents(self, fileids=None, categories=None):
+        return _RangeView(self._sent_ranges(fileids, categories), lambda i: self._sent(i, False))
+
+    def tagged_sents(self, fileids=None, categories=None):
+        return _RangeView(self._sent_ranges(fileids, categories), lambda i: self._sent(i, True))
+
+cache_tagged_corpus(brown, 'brown_cache') # parses brown one last time
+
+cached_brown = CachedTaggedCorpus('brown_cache')
+cached_brown.tagged_sents()[0] == brown.tagged_sents()[0] # True
+cached_brown.words(categories="hobbies")[:10]
+len(cached_brown.tagged_sents(categories="news")) # 4623
+
+
 ##-- Specialized corpus: cmudict --##
 
 ##     The Carnegie Mellon University Pronouncing Dictionary
@@ -102,6 +422,153 @@ brown.tagged_words()[:50] # first fifty words, all tagged
 cmudict.dict()['idiosyncratic']
 cmudict.dict()['caravan']
 
+##-- A compact, shareable copy of cmudict --##
+#
+#   - cmudict.dict() holds every pronunciation as a Python list of strings,
+#     which takes up hundreds of MB if many processes each load their own copy
+#   - there are fewer than 100 distinct phonemes (with stress), so each one
+#     fits in a single byte
+#   - we can write cmudict once into a binary file:
+#       header | phoneme names | word offsets | sorted words |
+#       word -> pronunciation offsets | pronunciation -> phoneme offsets | phoneme codes
+#   - the file is then memory-mapped (read-only), so all processes share one copy,
+#     and a pronunciation is only decoded back into strings when it is looked up
+
+import mmap, struct
+
+PRON_MAGIC = b'CMUP'
+PRON_VERSION = 1
+PRON_HEADER = struct.Struct('<4sIIIII') # magic, version, #phonemes, #words, #prons, #codes
+
+def pack_word_table(words):
+    # words must already be sorted by their utf-8 bytes: offsets, then the words
+    encoded = [word.encode('utf-8') for word in words]
+    offsets = [0]
+    for word in encoded:
+        offsets.append(offsets[-1] + len(word))
+    return struct.pack('<%dI' % len(offsets), *offsets) + b''.join(encoded)
+
+def build_pron_store(path, entries):
+    # entries: (word, pronunciation) pairs, e.g. cmudict.entries()
+    prons = {}
+    for word, pronun in entries:
+        prons.setdefault(word, []).append(pronun)
+    words = sorted(prons, key=lambda w: w.encode('utf-8'))
+    phones = sorted(set(p for word in words for pronun in prons[word] for p in pronun))
+    if len(phones) > 256:
+        raise ValueError('too many distinct phonemes to store as bytes')
+    phone_ids = dict((p, i) for i, p in enumerate(phones))
+
+    word_prons, pron_offsets, codes = [0], [0], bytearray()
+    for word in words:
+        for pronun in prons[word]:
+            codes.extend(phone_ids[p] for p in pronun)
+            pron_offsets.append(len(codes))
+        word_prons.append(len(pron_offsets) - 1)
+
+    phone_blob = '\n'.join(phones).encode('ascii')
+    with open(path, 'wb') as output:
+        output.write(PRON_HEADER.pack(PRON_MAGIC, PRON_VERSION, len(phones),
+                                      len(words), len(pron_offsets) - 1, len(codes)))
+        output.write(struct.pack('<I', len(phone_blob)) + phone_blob)
+        output.write(pack_word_table(words))
+        output.write(struct.pack('<%dI' % len(word_prons), *word_prons))
+        output.write(struct.pack('<%dI' % len(pron_offsets), *pron_offsets))
+        output.write(bytes(codes))
+
+class MappedFile(object):
+    # shared by the memory-mapped formats in this file: self.buf is the mmap,
+    # self.word_offsets/self.word_blob are where the sorted word table starts
+
+    def _int(self, section, i):
+        return struct.unpack_from('<I', self.buf, section + 4 * i)[0]
+
+    def _word(self, i):
+        start = self.word_blob + self._int(self.word_offsets, i)
+        end = self.word_blob + self._int(self.word_offsets, i + 1)
+        return self.buf[start:end]
+
+    def _find(self, word):
+        # binary search over the sorted words
+        target = word.encode('utf-8')
+        lo, hi = 0, self.n_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_words and self._word(lo) == target:
+            return lo
+        return None
+
+class PronStore(MappedFile):
+
+    def __init__(self, path):
+        with open(path, 'rb') as input:
+            self.buf = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_phones, n_words, n_prons, n_codes = PRON_HEADER.unpack_from(self.buf, 0)
+        if magic != PRON_MAGIC or version != PRON_VERSION:
+            raise ValueError('%s is not a version %d pronunciation store' % (path, PRON_VERSION))
+        pos = PRON_HEADER.size
+        (phone_len,) = struct.unpack_from('<I', self.buf, pos)
+        pos += 4
+        self.phones = self.buf[pos:pos + phone_len].decode('ascii').split('\n')
+        pos += phone_len
+        # only the positions of each section are kept; the data stays in the file
+        self.n_words = n_words
+        self.word_offsets = pos
+        pos += 4 * (n_words + 1)
+        self.word_blob = pos
+        pos += struct.unpack_from('<I', self.buf, self.word_offsets + 4 * n_words)[0]
+        self.word_prons = pos
+        pos += 4 * (n_words + 1)
+        self.pron_offsets = pos
+        pos += 4 * (n_prons + 1)
+        self.codes = pos
+
+    def _pron(self, j):
+        start = self.codes + self._int(self.pron_offsets, j)
+        end = self.codes + self._int(self.pron_offsets, j + 1)
+        return [self.phones[c] for c in bytearray(self.buf[start:end])]
+
+    def __len__(self):
+        return self.n_words
+
+    def __contains__(self, word):
+        return self._find(word) is not None
+
+    def __getitem__(self, word):
+        i = self._find(word)
+        if i is None:
+            raise KeyError(word)
+        return [self._pron(j) for j in range(self._int(self.word_prons, i),
+                                             self._int(self.word_prons, i + 1))]
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+    def words(self):
+        return [self._word(i).decode('utf-8') for i in range(self.n_words)]
+
+    def entries(self):
+        # same order as the store (sorted by word), one pair per pronunciation
+        for i in range(self.n_words):
+            word = self._word(i).decode('utf-8')
+            for j in range(self._int(self.word_prons, i), self._int(self.word_prons, i + 1)):
+                yield word, self._pron(j)
+
+build_pron_store('cmudict.bin', cmudict.entries()) # only needs to be done once
+
+# In any other Python process (the file is shared, not copied):
+prons = PronStore('cmudict.bin')
+prons['caravan'] # same as cmudict.dict()['caravan']
+'caravan' in prons
+len(prons)
+
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~ ###
 ### 2. Tokenizing Sentences ###
@@ -136,6 +603,73 @@ pattern = r'''(?x)                # set flag to allow verbose regexps (strip out
 
 nltk.regexp_tokenize(text, pattern)
 
+##-- Tokenizing a whole corpus on several cores --##
+#
+#   - nltk.regexp_tokenize(gutenberg.raw(), pattern) runs on one core and
+#     returns one giant list of tokens
+#   - none of the tokens in the pattern above can contain a newline, so we can
+#     cut the text after any newline and tokenize the pieces separately
+#     without changing the result
+#   - the pieces are tokenized in worker processes (each with its own copy of
+#     the compiled pattern), and the tokens come back in their original order,
+#     one piece at a time
+#   - NOTE: only use a boundary that no token of your pattern can cross,
+#     e.g. r'\s' also works for the pattern above (it never matches whitespace)
+
+from multiprocessing import Pool
+
+# NOTE on worker processes (here and in the later sections that use Pool):
+#   - on Linux, each worker starts as a copy of this Python session ("fork"),
+#     so everything also works when typed in interactively
+#   - on Windows, and on macOS since Python 3.8, a worker starts a new Python
+#     that imports the main script again ("spawn"), so the code that starts
+#     the workers has to be in a script, under  if __name__ == '__main__':
+#     (otherwise every worker would start workers of its own), and whatever
+#     is sent to the workers has to be picklable
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _tokenize_chunk(chunk):
+    return _worker_tokenizer.tokenize(chunk)
+
+class ParallelRegexpTokenizer(object):
+
+    def __init__(self, pattern, processes=None, chunk_size=100000, boundary=r'\n'):
+        self.tokenizer = nltk.RegexpTokenizer(pattern)
+        self.tokenizer.tokenize('') # compile the pattern once, here
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.boundary = re.compile(boundary)
+
+    def chunks(self, text):
+        start = 0
+        while start < len(text):
+            m = self.boundary.search(text, start + self.chunk_size)
+            end = m.end() if m else len(text)
+            yield text[start:end]
+            start = end
+
+    def tokenize(self, text):
+        # a generator: tokens are produced as the pieces are finished
+        pool = Pool(self.processes, _init_tokenize_worker, (self.tokenizer,))
+        try:
+            for tokens in pool.imap(_tokenize_chunk, self.chunks(text)):
+                for token in tokens:
+                    yield token
+        finally:
+            pool.terminate()
+            pool.join()
+
+# NOTE: on Windows and macOS, see the note on worker processes above
+
+tokenizer = ParallelRegexpTokenizer(pattern)
+list(tokenizer.tokenize(text)) == nltk.regexp_tokenize(text, pattern) # True
+
+for token in tokenizer.tokenize(gutenberg.raw()):
+    pass # do something with each token, without keeping the whole list
+
 
 ### ~~~~~~~~~~~ ###
 ### 3. Stemming ###
@@ -169,6 +703,323 @@ text2 = brown.sents()[2004]
 # For example, you could find all forms of "increas" ("increase", "increasing", "increased",
 # "increasingly", etc.) and create a concordance list.
 
+##-- Stemming each word type only once --##
+#
+#   - a corpus has far fewer distinct words (types) than words (tokens), e.g.
+#     "the" alone is about 6% of the Brown corpus
+#   - [porter.stem(t) for t in text] stems "the" again every time it shows up
+#   - a cache remembers the stems it has already worked out:
+#       - it keeps at most maxsize stems, throwing out the least recently used
+#       - it can be saved to a file and loaded again in a later session
+#       - one cache can be shared by several stemmers (the stemmer's name is
+#         part of the key), and it counts its hits and misses
+#       - two stemmers of the same kind can have different settings (e.g.
+#         PorterStemmer's modes), so a stemmer object needs a name of its own;
+#         only a plain function like regex_stem is named after itself
+#   - stem_corpus() goes one step further: it stems every type once and then
+#     maps the stems back onto the tokens
+
+import os, inspect
+from collections import OrderedDict
+from pickle import dump, load
+
+def regex_stem(word):
+    # the regex stemmer from above, as a function
+    for stem, suffix in re.findall(r'^(.*?)(ing|ly|ed|ious|ies|ive|es|s|ment)$', word):
+        return stem
+    return word
+
+class StemCache(object):
+
+    def __init__(self, maxsize=100000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.stems = OrderedDict() # (stemmer name, word) -> stem, oldest first
+        self.hits = self.misses = 0
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as input:
+                self.stems.update(load(input))
+
+    def lookup(self, key):
+        stem = self.stems.pop(key, None)
+        if stem is None:
+            self.misses += 1
+        else:
+            self.stems[key] = stem # now the most recently used
+            self.hits += 1
+        return stem
+
+    def store(self, key, stem):
+        self.stems[key] = stem
+        if len(self.stems) > self.maxsize:
+            self.stems.popitem(last=False)
+
+    def save(self, path=None):
+        with open(path or self.path, 'wb') as output:
+            dump(list(self.stems.items()), output, -1)
+
+class CachedStemmer(object):
+
+    def __init__(self, stemmer, cache, name=None):
+        # stemmer: an NLTK stemmer (give it a name), or a function like regex_stem
+        self._stem = getattr(stemmer, 'stem', stemmer)
+        self.cache = cache
+        if name is None:
+            # only a plain function is named after itself (porter.stem would be just 'stem')
+            if not inspect.isfunction(stemmer) or stemmer.__name__ == '<lambda>':
+                raise ValueError('a name is needed for this stemmer, e.g. '
+                                 'CachedStemmer(porter, cache, "porter")')
+            name = stemmer.__name__
+        self.name = name
+
+    def stem(self, word):
+        key = (self.name, word)
+        stem = self.cache.lookup(key)
+        if stem is None:
+            stem = self._stem(word)
+            self.cache.store(key, stem)
+        return stem
+
+    def stem_corpus(self, tokens):
+        tokens = list(tokens)
+        stems = dict((t, self.stem(t)) for t in set(tokens))
+        return [stems[t] for t in tokens]
+
+cache = StemCache(path='stems.pkl')
+cached_porter = CachedStemmer(porter, cache, 'porter')
+cached_lancaster = CachedStemmer(lancaster, cache, 'lancaster')
+cached_regex = CachedStemmer(regex_stem, cache) # named 'regex_stem'
+
+[cached_porter.stem(t) for t in text2] # same as [porter.stem(t) for t in text2]
+cached_lancaster.stem_corpus(brown.words(categories="news"))
+cached_regex.stem_corpus(gutenberg.words('austen-emma.txt'))
+cache.hits, cache.misses
+cache.save() # reloaded automatically by StemCache(path='stems.pkl')
+
+##-- A concordance by stem, across corpora --##
+#
+#   - to find all forms of "increas" in several texts we would have to stem
+#     every token of every text again for every search
+#   - instead, an index is built once: every word type is stemmed once, and
+#     for every stem we keep where it occurs, as (file, sentence, position in
+#     the sentence)
+#   - the positions are stored as small differences from the one before
+#     (most are in the same file, and often in the same sentence), packed
+#     into as few bytes as they need: 1 byte for numbers up to 127, 2 bytes
+#     up to 16383, etc.
+#   - the words themselves are stored as integer ids, so the context of a hit
+#     can be shown without reading the file again
+#   - more files (or a whole new corpus) can be added later; the files that
+#     are already in the index are skipped
+
+def _add_number(buf, n):
+    while n >= 128:
+        buf.append(n & 127 | 128)
+        n >>= 7
+    buf.append(n)
+
+def _read_numbers(buf):
+    n = shift = 0
+    for byte in buf:
+        n |= (byte & 127) << shift
+        if byte & 128:
+            shift += 7
+        else:
+            yield n
+            n = shift = 0
+
+class StemIndex(object):
+
+    def __init__(self, stemmer):
+        # stemmer: an NLTK stemmer, a function like regex_stem, or a CachedStemmer
+        self.stemmer = stemmer
+        self.docs = [] # (corpus name, fileid)
+        self.doc_index = {}
+        self.id2word = []
+        self.word_index = {}
+        self.stems = [] # word id -> stem
+        self.tokens = [] # for each file: the ids of its words
+        self.sent_starts = [] # for each file: where each sentence starts in its tokens
+        self.packed = {} # stem -> (file, sentence, position) differences, packed
+        self.last = {} # stem -> its last (file, sentence, position)
+
+    def stem(self, word):
+        return getattr(self.stemmer, 'stem', self.stemmer)(word.lower())
+
+    def _word_id(self, word):
+        i = self.word_index.get(word)
+        if i is None:
+            i = self.word_index[word] = len(self.id2word)
+            self.id2word.append(word)
+            self.stems.append(self.stem(word))
+        return i
+
+    def _add_posting(self, stem, doc, sent, offset):
+        buf = self.packed.get(stem)
+        if buf is None:
+            buf = self.packed[stem] = bytearray()
+        last_doc, last_sent, last_offset = self.last.get(stem, (0, 0, 0))
+        if doc != last_doc:
+            numbers = (doc - last_doc, sent, offset)
+        elif sent != last_sent:
+            numbers = (0, sent - last_sent, offset)
+        else:
+            numbers = (0, 0, offset - last_offset)
+        for n in numbers:
+            _add_number(buf, n)
+        self.last[stem] = (doc, sent, offset)
+
+    def add_corpus(self, name, corpus, fileids=None):
+        # returns the number of files added
+        added = 0
+        for fileid in corpus.fileids() if fileids is None else fileids:
+            if (name, fileid) in self.doc_index:
+                continue
+            doc = self.doc_index[name, fileid] = len(self.docs)
+            self.docs.append((name, fileid))
+            tokens, sent_starts = array('i'), array('i')
+            for sent, sentence in enumerate(corpus.sents(fileid)):
+                sent_starts.append(len(tokens))
+                for offset, word in enumerate(sentence):
+                    i = self._word_id(word)
+                    tokens.append(i)
+                    self._add_posting(self.stems[i], doc, sent, offset)
+            self.tokens.append(tokens)
+            self.sent_starts.append(sent_starts)
+            added += 1
+        return added
+
+    def _postings(self, stem):
+        # yields (file number, sentence, position), in order
+        doc = sent = offset = 0
+        numbers = _read_numbers(self.packed.get(stem, b''))
+        for d_doc, d_sent, d_offset in zip(numbers, numbers, numbers):
+            if d_doc:
+                doc, sent, offset = doc + d_doc, d_sent, d_offset
+            elif d_sent:
+                sent, offset = sent + d_sent, d_offset
+            else:
+                offset += d_offset
+            yield doc, sent, offset
+
+    def postings(self, word):
+        # (corpus name, fileid, sentence, position) of every word with the same stem as word
+        return [self.docs[doc] + (sent, offset) for doc, sent, offset in self._postings(self.stem(word))]
+
+    def forms(self, word):
+        stem = self.stem(word)
+        return sorted(w for w, s in zip(self.id2word, self.stems) if s == stem)
+
+    def concordance(self, word, width=5, corpus=None):
+        # returns (corpus name, fileid, sentence, left context, word, right context) for every hit
+        hits = []
+        for doc, sent, offset in self._postings(self.stem(word)):
+            name, fileid = self.docs[doc]
+            if corpus is not None and name != corpus:
+                continue
+            tokens, sent_starts = self.tokens[doc], self.sent_starts[doc]
+            start = sent_starts[sent]
+            end = sent_starts[sent + 1] if sent + 1 < len(sent_starts) else len(tokens)
+            i = start + offset
+            words = [self.id2word[t] for t in tokens[max(start, i - width):min(end, i + width + 1)]]
+            left = words[:i - max(start, i - width)]
+            hits.append((name, fileid, sent, left, words[len(left)], words[len(left) + 1:]))
+        return hits
+
+    def print_concordance(self, word, width=5, lines=25, corpus=None):
+        for name, fileid, sent, left, hit, right in self.concordance(word, width, corpus)[:lines]:
+            print('%-20s %40s  %s  %s' % (fileid[:20], ' '.join(left)[-40:], hit, ' '.join(right)))
+
+    def save(self, path):
+        with open(path, 'wb') as output:
+            dump(self, output, -1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as input:
+            return load(input)
+
+stem_index = StemIndex(cached_porter) # shares the stem cache from above
+stem_index.add_corpus('gutenberg', gutenberg)
+stem_index.add_corpus('brown', brown) # a minute or so for both, once
+
+stem_index.forms('increase')
+# Returns: ['Increase', 'Increased', 'Increasing', 'increase', 'increased', 'increases', ...]
+stem_index.print_concordance('increase') # from all the texts, in a few milliseconds
+stem_index.print_concordance('increase', corpus='brown')
+
+stem_index.save('stem_index.pkl')
+stem_index = StemIndex.load('stem_index.pkl')
+# stem_index.add_corpus('poetry', poetry) # the corpus from section 7; run it again later and
+                                          # only the new poems are added
+
+##-- The regex stemmer without the regex --##
+#
+#   - for every word, re.findall(r'^(.*?)(ing|ly|...)$', word) tries a stem of
+#     length 0, then 1, then 2, ..., and at each one tries all the suffixes in
+#     turn, until one of them reaches the end of the word
+#   - so it always finds the longest suffix that the word ends with (e.g.
+#     "ies" rather than "es" or "s"), whatever the order of the suffixes
+#   - instead, the suffixes can be put into a tree of letters read from the
+#     end (like the trie in the regex tutorial, but backwards): starting from
+#     the last letter of the word, we follow the tree as far as it goes, and
+#     the last place where a suffix ended is the longest suffix
+#   - two optional rules on top:
+#       - min_stem: don't leave a stem shorter than this many letters (then a
+#         shorter suffix is tried, or the word stays as it is)
+#       - exceptions: words with a stem of their own, e.g. {'lying': 'lie'}
+#   - with min_stem=0 and no exceptions, the stems are the same as regex_stem()
+
+REGEX_SUFFIXES = ('ing', 'ly', 'ed', 'ious', 'ies', 'ive', 'es', 's', 'ment')
+
+class SuffixStemmer(object):
+
+    def __init__(self, suffixes=REGEX_SUFFIXES, min_stem=0, exceptions=None):
+        self.min_stem = min_stem
+        self.exceptions = dict(exceptions or {})
+        self.tree = {} # letter -> subtree; '' marks the end of a suffix
+        for suffix in suffixes:
+            node = self.tree
+            for char in reversed(suffix):
+                node = node.setdefault(char, {})
+            node[''] = True
+
+    def stem(self, word):
+        if word in self.exceptions:
+            return self.exceptions[word]
+        if '\n' in word:
+            return regex_stem(word) # . in the regex doesn't match a newline
+        node, cut = self.tree, None
+        i = len(word)
+        while i > self.min_stem:
+            node = node.get(word[i - 1])
+            if node is None:
+                break
+            i -= 1
+            if '' in node:
+                cut = i # a suffix starts here, and it's the longest so far
+        return word if cut is None else word[:cut]
+
+    def stem_all(self, words):
+        # a whole text or vocabulary: each word type is stemmed once
+        words = list(words)
+        stems = dict((w, self.stem(w)) for w in set(words))
+        return [stems[w] for w in words]
+
+suffix_stemmer = SuffixStemmer()
+suffix_stemmer.stem('processes'), suffix_stemmer.stem('basis'), suffix_stemmer.stem('lying')
+# Returns: ('process', 'basi', 'ly') (the same as the regex)
+
+vocabulary = set(brown.words()) | set(gutenberg.words())
+all(suffix_stemmer.stem(w) == regex_stem(w) for w in vocabulary) # True
+
+careful = SuffixStemmer(min_stem=3, exceptions={'lying': 'lie', 'basis': 'basis'})
+careful.stem_all(['processes', 'basis', 'lying', 'sing', 'things'])
+# Returns: ['process', 'basis', 'lie', 'sing', 'thing']
+
+# It can be used like the other stemmers, e.g. CachedStemmer(careful, cache, 'careful')
+# or StemIndex(careful).
+
 
 ### ~~~~~~~~~~~~~~~~ ###
 ### 4. Lemmatization ###
@@ -178,6 +1029,78 @@ text2 = brown.sents()[2004]
 wnl = nltk.WordNetLemmatizer()
 [wnl.lemmatize(t) for t in text2]
 
+##-- A precomputed lemma table --##
+#
+#   - wnl.lemmatize() looks every token up in WordNet, and the very first call
+#     has to load WordNet, which takes a while
+#   - for a batch job we know the vocabulary beforehand, so we can lemmatize
+#     every word type once for each part of speech and keep the results
+#   - most words are their own lemma, so only the words that change are
+#     stored; the rest of the vocabulary is just a set
+#   - FastLemmatizer answers from the table, and only loads WordNet for words
+#     it hasn't seen (and remembers those answers too)
+
+LEMMA_POS = ('n', 'v', 'a', 'r') # noun, verb, adjective, adverb
+
+class FastLemmatizer(object):
+
+    def __init__(self, words, pos=LEMMA_POS):
+        # words: any list of tokens, e.g. brown.words(), gutenberg.words(), poetry.words()
+        self.vocab = set(words)
+        self.lemmas = dict((p, {}) for p in pos) # pos -> {word: lemma}, only if different
+        self._wnl = None
+        wnl = self._wordnet()
+        for word in self.vocab:
+            for p in pos:
+                lemma = wnl.lemmatize(word, p)
+                if lemma != word:
+                    self.lemmas[p][word] = lemma
+
+    def _wordnet(self):
+        if self._wnl is None:
+            self._wnl = nltk.WordNetLemmatizer()
+        return self._wnl
+
+    def lemmatize(self, word, pos='n'):
+        lemmas = self.lemmas.get(pos)
+        if lemmas is not None:
+            lemma = lemmas.get(word)
+            if lemma is not None:
+                return lemma
+            if word in self.vocab:
+                return word
+        lemma = self._wordnet().lemmatize(word, pos)
+        if lemmas is not None:
+            self.vocab.add(word)
+            if lemma != word:
+                lemmas[word] = lemma
+        return lemma
+
+    def lemmatize_all(self, tokens, pos='n'):
+        return [self.lemmatize(t, pos) for t in tokens]
+
+    def save(self, path):
+        wnl, self._wnl = self._wnl, None # don't store the WordNet lemmatizer
+        try:
+            with open(path, 'wb') as output:
+                dump(self, output, -1)
+        finally:
+            self._wnl = wnl
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as input:
+            return load(input)
+
+fast_wnl = FastLemmatizer(brown.words()) # takes a while, but only once
+fast_wnl.save('lemmas.pkl')
+
+# In a later session (WordNet is not loaded at all unless an unseen word comes up):
+fast_wnl = FastLemmatizer.load('lemmas.pkl')
+fast_wnl.lemmatize_all(text2) # same as [wnl.lemmatize(t) for t in text2]
+fast_wnl.lemmatize('running', 'v')
+# Returns: 'run'
+
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~ ###
 ### 5. Tagging (Part of Speech) ###
@@ -208,6 +1131,77 @@ re_tagger.tag(brown.sents()[3])
 re_tagger.evaluate(brown.tagged_sents()[-1000:])
 # only about 17.7% accuracy
 
+##-- Matching all of the patterns at once --##
+#
+#   - nltk.RegexpTagger tries the patterns one at a time, so a noun at the
+#     end of the list costs eight re.match() calls
+#   - we can join the patterns into a single regex, each one inside its own
+#     named group:  (?P<p0>.*ing$)|(?P<p1>.*ed$)|...
+#   - alternatives are tried from left to right, so the first pattern that
+#     matches still wins, and the name of the group that matched (m.lastgroup)
+#     tells us which tag to give
+#   - NOTE: the patterns can't use numbered backreferences (\1), since the
+#     extra groups change the numbering
+#   - NOTE: flags written at the start of a pattern, like (?i).*ING$, would
+#     end up in the middle of the combined regex, where they aren't allowed;
+#     they are turned into flags for that pattern only: (?i:.*ING$)
+#     (this needs Python 3.6 or later; elsewhere inline flags aren't allowed)
+
+_INLINE_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+
+def _scope_flags(regexp):
+    flags = ''
+    m = _INLINE_FLAGS.match(regexp)
+    while m:
+        flags += m.group(1)
+        regexp = regexp[m.end():]
+        m = _INLINE_FLAGS.match(regexp)
+    if not flags:
+        return regexp
+    if 'x' in flags:
+        regexp += '\n' # so that a comment at the end can't swallow the ')'
+    return '(?%s:%s)' % (flags, regexp)
+
+class CompiledRegexpTagger(nltk.SequentialBackoffTagger):
+
+    def __init__(self, regexps, backoff=None):
+        nltk.SequentialBackoffTagger.__init__(self, backoff)
+        parts = []
+        self._tags = {}
+        for i, (regexp, tag) in enumerate(regexps):
+            name = 'p%d' % i
+            parts.append('(?P<%s>%s)' % (name, _scope_flags(regexp)))
+            self._tags[name] = tag
+        try:
+            self._regexp = re.compile('|'.join(parts))
+        except re.error as e:
+            raise ValueError('the patterns cannot be combined into one regex (%s); '
+                             'see the NOTEs above' % e)
+
+    def choose_tag(self, tokens, index, history):
+        m = self._regexp.match(tokens[index])
+        if m is None:
+            return None
+        return self._tags[m.lastgroup]
+
+    def tag(self, tokens):
+        if self.backoff is not None:
+            return nltk.SequentialBackoffTagger.tag(self, tokens)
+        match, tags = self._regexp.match, self._tags
+        tagged = []
+        for token in tokens:
+            m = match(token)
+            tagged.append((token, tags[m.lastgroup] if m else None))
+        return tagged
+
+    def tag_sents(self, sentences):
+        return [self.tag(sent) for sent in sentences]
+
+fast_re_tagger = CompiledRegexpTagger(patterns)
+fast_re_tagger.tag(brown.sents()[3]) == re_tagger.tag(brown.sents()[3]) # True
+fast_re_tagger.evaluate(brown.tagged_sents()[-1000:]) # the same 17.7%
+fast_re_tagger.tag_sents(brown.sents(categories="news")) # a whole category at once
+
 
 ## - - - - - - - - -  ##
 ## 5.2. Lookup tagger ##
@@ -232,6 +1226,83 @@ baseline_tagger.tag(brown.sents()[3]) # Note: a lot of 'None' tags
 baseline_tagger.evaluate(brown.tagged_sents()[-1000:])
 # a lot better at 49.1% accuracy
 
+##-- Building the lookup tagger in one pass --##
+#
+#   - the code above reads the news corpus twice (once for fd, once for cfd)
+#     and then sorts every word in fd just to keep the first 100
+#   - the same numbers can be counted in a single pass over the tagged
+#     sentences with plain dictionaries:
+#       word -> count,  word -> {tag: count}
+#   - heapq.nlargest() picks the top k words without sorting all of them
+#   - counts from different parts of a corpus can simply be added together,
+#     so they can be counted on several cores, or topped up with new text later
+
+import heapq
+
+class LookupCounts(object):
+
+    def __init__(self, tagged_sents=()):
+        self.words = {} # word -> count
+        self.tags = {}  # word -> {tag: count}
+        self.add(tagged_sents)
+
+    def add(self, tagged_sents):
+        words, tags = self.words, self.tags
+        for sent in tagged_sents:
+            for word, tag in sent:
+                words[word] = words.get(word, 0) + 1
+                word_tags = tags.get(word)
+                if word_tags is None:
+                    word_tags = tags[word] = {}
+                word_tags[tag] = word_tags.get(tag, 0) + 1
+
+    def update(self, other):
+        for word, count in other.words.items():
+            self.words[word] = self.words.get(word, 0) + count
+        for word, other_tags in other.tags.items():
+            word_tags = self.tags.setdefault(word, {})
+            for tag, count in other_tags.items():
+                word_tags[tag] = word_tags.get(tag, 0) + count
+
+    def likely_tags(self, top_k=100):
+        most_freq_words = heapq.nlargest(top_k, self.words, key=self.words.get)
+        return dict((word, max(self.tags[word], key=self.tags[word].get))
+                    for word in most_freq_words)
+
+def build_lookup_tagger(tagged_sents, top_k=100, backoff=None):
+    counts = tagged_sents if isinstance(tagged_sents, LookupCounts) else LookupCounts(tagged_sents)
+    return nltk.UnigramTagger(model=counts.likely_tags(top_k), backoff=backoff)
+
+def _init_lookup_worker(corpus):
+    global _worker_corpus
+    _worker_corpus = corpus
+
+def _count_lookup_shard(fileids):
+    return LookupCounts(_worker_corpus.tagged_sents(fileids))
+
+def parallel_lookup_counts(corpus, fileids=None, processes=None, shard_size=10):
+    if fileids is None:
+        fileids = corpus.fileids()
+    shards = [fileids[i:i + shard_size] for i in range(0, len(fileids), shard_size)]
+    counts = LookupCounts()
+    pool = Pool(processes, _init_lookup_worker, (corpus,))
+    try:
+        for shard_counts in pool.imap(_count_lookup_shard, shards): # in order, for the ties
+            counts.update(shard_counts)
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+baseline_tagger = build_lookup_tagger(brown.tagged_sents(categories='news'), 100)
+baseline_tagger.evaluate(brown.tagged_sents()[-1000:]) # the same 49.1% as above
+
+# Counting on all cores, then adding more text later without counting again
+# (on Windows and macOS, see the note on worker processes in section 2):
+counts = parallel_lookup_counts(brown, brown.fileids(categories='news'))
+counts.add(brown.tagged_sents(categories='editorial'))
+baseline_tagger = build_lookup_tagger(counts, 100)
+
 
 ## - - - - - -  ##
 ## 5.3. Backoff ##
@@ -299,6 +1370,561 @@ t3 = nltk.TrigramTagger(news_train, backoff=t2)
 t3.evaluate(news_test)
 # 84.4% accuracy (compared to 81.3% using just nltk.UnigramTagger())
 
+##-- Fusing a backoff chain into a single tagger --##
+#
+#   - t3.tag() asks t3, then t2, then t1, then t0 for every token, and each
+#     of them builds its own context tuple before looking it up
+#   - but all the trained taggers really are just dictionaries:
+#       unigram: word -> tag
+#       bigram:  ((previous tag,), word) -> tag
+#       trigram: ((tag before that, previous tag), word) -> tag
+#   - we can regroup them under the word, so a single lookup finds everything
+#     the chain knows about that word, in backoff order:
+#       word -> ([(# previous tags, {previous tags: tag}), ...], unigram tag)
+#   - the previous tags are kept in one tuple that is updated once per token,
+#     instead of every tagger slicing the history again
+#   - words that none of the trained taggers have seen go straight to the
+#     final (e.g. default) tagger
+
+class FusedBackoffTagger(object):
+
+    def __init__(self, tagger):
+        levels = {}
+        self.default = None
+        self.fallback = None
+        self.history = 0
+        for i, t in enumerate(tagger._taggers):
+            if isinstance(t, nltk.UnigramTagger):
+                k = 0
+            elif isinstance(t, nltk.NgramTagger):
+                k = t._n - 1
+            elif isinstance(t, nltk.DefaultTagger):
+                self.default = t.choose_tag(None, None, None)
+                break
+            else:
+                # any other kind of tagger (and its own backoffs) is asked as before
+                self.fallback = t
+                break
+            self.history = max(self.history, k)
+            for context, tag in t._context_to_tag.items():
+                if k == 0:
+                    tag_context, word = (), context
+                else:
+                    tag_context, word = context
+                levels.setdefault(word, {}).setdefault(i, (k, {}))[1][tag_context] = tag
+
+        self.table = {}
+        for word, word_levels in levels.items():
+            ngrams, unigram = [], None
+            for i in sorted(word_levels):
+                k, contexts = word_levels[i]
+                if k == 0:
+                    # a unigram tagger always knows its words, so nothing after it is asked
+                    unigram = contexts[()]
+                    break
+                ngrams.append((k, contexts))
+            self.table[word] = (ngrams, unigram)
+
+    def tag(self, tokens):
+        table, default, fallback, n = self.table, self.default, self.fallback, self.history
+        tags = []
+        recent = () # the last n tags
+        for i, word in enumerate(tokens):
+            tag = None
+            entry = table.get(word)
+            if entry is not None:
+                ngrams, tag = entry
+                for k, contexts in ngrams:
+                    found = contexts.get(recent if k == n else recent[-k:])
+                    if found is not None:
+                        tag = found
+                        break
+            if tag is None:
+                if fallback is not None:
+                    tag = fallback.tag_one(tokens, i, tags)
+                else:
+                    tag = default
+            tags.append(tag)
+            recent = (recent + (tag,))[-n:] if n else ()
+        return list(zip(tokens, tags))
+
+    def tag_sents(self, sentences):
+        return [self.tag(sent) for sent in sentences]
+
+    def evaluate(self, gold):
+        correct = total = 0
+        for sent in gold:
+            tagged = self.tag([word for (word, tag) in sent])
+            for (word, tag), (gold_word, gold_tag) in zip(tagged, sent):
+                correct += (tag == gold_tag)
+                total += 1
+        return float(correct) / total
+
+fast_t3 = FusedBackoffTagger(t3)
+fast_t3.tag(brown.sents()[3]) == t3.tag(brown.sents()[3]) # True
+fast_t3.evaluate(news_test) # same 84.4% accuracy
+
+# Comparing the speed on all of the news sentences:
+
+import time
+news_sents = brown.sents(categories="news")
+start = time.time(); t3.tag_sents(news_sents); time.time() - start
+start = time.time(); fast_t3.tag_sents(news_sents); time.time() - start
+# the fused tagger is several times faster
+
+##-- k-fold cross-validation (in parallel) --##
+#
+#   - a single 90/10 split only gives us one accuracy number, which depends
+#     a lot on which sentences happen to end up in the last 10%
+#   - with k-fold cross-validation the data is cut into k parts, and each part
+#     takes a turn being the test set while the tagger trains on the rest
+#   - the folds don't depend on each other, so they can all run at the same
+#     time on different cores
+#   - the corpus is read (and decoded) only once; the worker processes get
+#     that one copy instead of each reading the files again
+
+def train_backoff_tagger(train_sents, default='NN'):
+    t0 = nltk.DefaultTagger(default)
+    t1 = nltk.UnigramTagger(train_sents, backoff=t0)
+    t2 = nltk.BigramTagger(train_sents, backoff=t1)
+    return nltk.TrigramTagger(train_sents, backoff=t2)
+
+def _init_cv_worker(sents, k):
+    global _cv_sents, _cv_k
+    _cv_sents, _cv_k = sents, k
+
+def _run_fold(fold):
+    start = time.time()
+    n = len(_cv_sents)
+    lo, hi = fold * n // _cv_k, (fold + 1) * n // _cv_k
+    tagger = train_backoff_tagger(_cv_sents[:lo] + _cv_sents[hi:])
+    accuracy = FusedBackoffTagger(tagger).evaluate(_cv_sents[lo:hi])
+    return fold, accuracy, time.time() - start
+
+def cross_validate(tagged_sents, k=10, processes=None):
+    sents = list(tagged_sents) # read the corpus only once
+    pool = Pool(processes, _init_cv_worker, (sents, k))
+    try:
+        results = pool.map(_run_fold, range(k))
+    finally:
+        pool.close()
+        pool.join()
+    return results # [(fold, accuracy, seconds), ...]
+
+# NOTE: on Windows and macOS, see the note on worker processes in section 2
+
+for fold, accuracy, seconds in cross_validate(brown.tagged_sents(categories="news")):
+    print('fold %d: %.1f%% accuracy (%.1f s)' % (fold, 100 * accuracy, seconds))
+
+for category in brown.categories():
+    results = cross_validate(brown.tagged_sents(categories=category), k=5)
+    print('%-16s %.1f%%' % (category, 100 * sum(r[1] for r in results) / len(results)))
+
+##-- Training all the n-gram levels at once, in parallel --##
+#
+#   - t1, t2 and t3 each go through all of news_train again just to count
+#     how often each tag appears in each of their contexts
+#   - the counts for all three can be collected in the same pass, and the
+#     counts of different parts of the corpus can simply be added up, so the
+#     counting can be split over several cores
+#   - the taggers are then built from the counts, from the bottom up. Like
+#     NLTK, a context is only kept if the tagger below it would get at least
+#     one of its tokens wrong. Since the context says everything the lower
+#     taggers look at (the word and the previous tags), we can check this
+#     with the counts alone, and end up with exactly the same t3
+#   - new tagged text only has to be counted and added; building the taggers
+#     again from the counts is quick
+
+class NgramCounts(object):
+
+    def __init__(self, n=3, tagged_sents=()):
+        self.n = n
+        # counts[k]: context -> {tag: count}, where k is the number of previous
+        # tags (the context is just the word for k = 0, as in UnigramTagger)
+        self.counts = [{} for k in range(n)]
+        self.add(tagged_sents)
+
+    def add(self, tagged_sents):
+        n, counts = self.n, self.counts
+        for sent in tagged_sents:
+            tags = [tag for (word, tag) in sent]
+            for i, (word, tag) in enumerate(sent):
+                for k in range(n):
+                    context = word if k == 0 else (tuple(tags[max(0, i - k):i]), word)
+                    tag_counts = counts[k].get(context)
+                    if tag_counts is None:
+                        tag_counts = counts[k][context] = {}
+                    tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+    def contexts(self, k):
+        # (context, {tag: count}) for every context with k previous tags
+        return self.counts[k].items()
+
+    def update(self, other):
+        # NOTE: add the counts in corpus order, so that ties between equally
+        # frequent tags are broken the same way as in NLTK (first seen wins)
+        for mine, theirs in zip(self.counts, other.counts):
+            for context, tag_counts in theirs.items():
+                my_counts = mine.setdefault(context, {})
+                for tag, count in tag_counts.items():
+                    my_counts[tag] = my_counts.get(tag, 0) + count
+
+    def train(self, default='NN', cutoff=0):
+        tagger = nltk.DefaultTagger(default) if default is not None else None
+        for k in range(self.n):
+            model = {}
+            for context, tag_counts in self.contexts(k):
+                best_tag = max(tag_counts, key=tag_counts.get)
+                if tag_counts[best_tag] <= cutoff:
+                    continue
+                if tagger is not None:
+                    # what would the taggers below this one say here?
+                    tag_context, word = ((), context) if k == 0 else context
+                    tokens = [None] * len(tag_context) + [word]
+                    predicted = tagger.tag_one(tokens, len(tag_context), list(tag_context))
+                    if all(tag == predicted for tag in tag_counts):
+                        continue
+                model[context] = best_tag
+            if not model:
+                continue # nothing to add at this level
+            if k == 0:
+                tagger = nltk.UnigramTagger(model=model, backoff=tagger)
+            else:
+                tagger = nltk.NgramTagger(k + 1, model=model, backoff=tagger)
+        return tagger
+
+def _init_ngram_worker(sents, n):
+    global _worker_sents, _worker_n
+    _worker_sents, _worker_n = sents, n
+
+def _count_ngram_shard(bounds):
+    lo, hi = bounds
+    return NgramCounts(_worker_n, _worker_sents[lo:hi])
+
+def parallel_ngram_counts(tagged_sents, n=3, processes=None, shard_size=500):
+    sents = list(tagged_sents)
+    shards = [(i, i + shard_size) for i in range(0, len(sents), shard_size)]
+    counts = NgramCounts(n)
+    pool = Pool(processes, _init_ngram_worker, (sents, n))
+    try:
+        for shard_counts in pool.imap(_count_ngram_shard, shards): # in order
+            counts.update(shard_counts)
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+# NOTE: on Windows and macOS, see the note on worker processes in section 2
+
+counts = parallel_ngram_counts(news_train)
+t3 = counts.train()
+t3.evaluate(news_test) # the same 84.4% as before
+
+# Adding more training data later only means counting the new sentences:
+counts.update(parallel_ngram_counts(brown.tagged_sents(categories="editorial")))
+t3_more = counts.train()
+
+##-- Counting 4- and 5-grams in a limited amount of memory --##
+#
+#   - NgramCounts keeps every context as a tuple of tag strings plus the word,
+#     with its own little dictionary of tag counts: a few hundred bytes per
+#     (context, tag), and the number of contexts grows quickly with n
+#   - here, words and tags get integer ids and a whole (word, previous tags,
+#     tag) is packed into one integer, TAG_BITS bits per tag:
+#       word id | newest previous tag | ... | oldest previous tag | tag
+#     so each count is a single entry of one dictionary (integer -> integer)
+#   - the context one level down (one previous tag less) is the same integer
+#     shifted right by TAG_BITS, which makes comparing the levels easy
+#   - prune() then throws out:
+#       - contexts seen fewer than min_count times
+#       - contexts whose tags are (almost) the same as one level down, so that
+#         the level below would do just as well (relative entropy pruning:
+#         how often the context occurs x how different its tags are)
+#   - with max_entries, the counts never get bigger than that: when they do,
+#     whole contexts of the higher levels are thrown out, the rarest first
+#     (and of two equally rare ones, the longer one), until only half of
+#     max_entries is used, so that this doesn't have to happen again soon;
+#     the unigram level is never thrown out
+#   - NOTE: once the limit has been reached, contexts that are new (or come
+#     back after being thrown out) start again from a count of 1, so they are
+#     the first to go at the next clear-out: only contexts that are frequent
+#     early enough, or often enough between two clear-outs, make it to the end
+#   - train() works the same as for NgramCounts, and as long as nothing was
+#     thrown out, gives the same tagger
+
+import math
+from itertools import groupby
+
+TAG_BITS = 10 # up to 1023 different tags (0 means "before the start of the sentence")
+TAG_MASK = (1 << TAG_BITS) - 1
+
+class HashedNgramCounts(NgramCounts):
+
+    def __init__(self, n=5, tagged_sents=(), max_entries=None):
+        self.n = n
+        self.max_entries = max_entries
+        self.id2word, self.word_index = [], {}
+        self.id2tag, self.tag_index = [None], {}
+        # counts[k]: packed (word, k previous tags, tag) -> count
+        self.counts = [{} for k in range(n)]
+        self.add(tagged_sents)
+
+    def _tag_id(self, tag):
+        t = self.tag_index.get(tag)
+        if t is None:
+            t = self.tag_index[tag] = len(self.id2tag)
+            if t > TAG_MASK:
+                raise ValueError('more than %d different tags' % TAG_MASK)
+            self.id2tag.append(tag)
+        return t
+
+    def _word_id(self, word):
+        w = self.word_index.get(word)
+        if w is None:
+            w = self.word_index[word] = len(self.id2word)
+            self.id2word.append(word)
+        return w
+
+    def _add_ids(self, word_ids, tag_ids):
+        n, counts = self.n, self.counts
+        for i, t in enumerate(tag_ids):
+            context = word_ids[i]
+            for k in range(n):
+                key = context << TAG_BITS | t
+                counts[k][key] = counts[k].get(key, 0) + 1
+                context = context << TAG_BITS | (tag_ids[i - k - 1] if i > k else 0)
+
+    def add(self, tagged_sents):
+        for sent in tagged_sents:
+            self._add_ids([self._word_id(word) for (word, tag) in sent],
+                          [self._tag_id(tag) for (word, tag) in sent])
+            if self.max_entries is not None and self.size() > self.max_entries:
+                self._evict()
+
+    def size(self):
+        return sum(len(level) for level in self.counts)
+
+    def _evict(self):
+        excess = self.size() - self.max_entries // 2
+        # (how often, -level) -> [(packed context, # entries), ...], without sorting the contexts
+        groups = {}
+        for k in range(1, self.n):
+            totals = {} # packed context -> [how often, # entries]
+            for key, count in self.counts[k].items():
+                total = totals.setdefault(key >> TAG_BITS, [0, 0])
+                total[0] += count
+                total[1] += 1
+            for context, (total, entries) in totals.items():
+                groups.setdefault((total, -k), []).append((context, entries))
+        thrown_out = [set() for k in range(self.n)]
+        for total, order in sorted(groups):
+            for context, entries in groups[total, order]:
+                if excess <= 0:
+                    break
+                thrown_out[-order].add(context)
+                excess -= entries
+        for k in range(1, self.n):
+            if thrown_out[k]:
+                # a new dictionary, since a dictionary doesn't shrink when keys are deleted
+                self.counts[k] = dict((key, count) for key, count in self.counts[k].items()
+                                      if key >> TAG_BITS not in thrown_out[k])
+
+    def _grouped(self, k):
+        # (packed context, [(tag id, count), ...]) for every context at level k
+        level = self.counts[k]
+        by_context = lambda key: key >> TAG_BITS
+        # a stable sort: within a context, the tags stay in the order they were first seen
+        for context, keys in groupby(sorted(level, key=by_context), by_context):
+            yield context, [(key & TAG_MASK, level[key]) for key in keys]
+
+    def _unpack(self, context, k):
+        tags = []
+        for j in range(k):
+            tags.append(context & TAG_MASK)
+            context >>= TAG_BITS
+        # the oldest tag came off first; 0s are positions before the start of the sentence
+        return [self.id2tag[t] for t in tags if t], self.id2word[context]
+
+    def contexts(self, k):
+        for context, tag_counts in self._grouped(k):
+            tags, word = self._unpack(context, k)
+            context = word if k == 0 else (tuple(tags), word)
+            yield context, dict((self.id2tag[t], count) for t, count in tag_counts)
+
+    def prune(self, min_count=2, threshold=None):
+        # returns the number of entries thrown out
+        before = self.size()
+        for k in range(self.n - 1, 0, -1): # the unigram level is always kept
+            level, lower = self.counts[k], self.counts[k - 1]
+            lower_totals = {}
+            if threshold is not None:
+                for key, count in lower.items():
+                    lower_totals[key >> TAG_BITS] = lower_totals.get(key >> TAG_BITS, 0) + count
+                n_tokens = float(sum(level.values()))
+            for context, tag_counts in list(self._grouped(k)):
+                total = sum(count for t, count in tag_counts)
+                prune = total < min_count
+                if not prune and threshold is not None:
+                    lower_context = context >> TAG_BITS
+                    lower_total = lower_totals.get(lower_context)
+                    if lower_total:
+                        divergence = 0.0
+                        for t, count in tag_counts:
+                            lower_count = lower.get(lower_context << TAG_BITS | t, 0.5)
+                            divergence += (count / float(total)) * math.log(
+                                (count / float(total)) / (lower_count / float(lower_total)))
+                        prune = total / n_tokens * divergence < threshold
+                if prune:
+                    for t, count in tag_counts:
+                        del level[context << TAG_BITS | t]
+        return before - self.size()
+
+    def update(self, other):
+        # other can have different ids for the same words and tags
+        words = [self._word_id(word) for word in other.id2word]
+        tags = [0] + [self._tag_id(tag) for tag in other.id2tag[1:]]
+        for k, level in enumerate(other.counts):
+            mine = self.counts[k]
+            for key, count in level.items():
+                new_key = tags[key & TAG_MASK]
+                key >>= TAG_BITS
+                shift = TAG_BITS
+                for j in range(k):
+                    new_key |= tags[key & TAG_MASK] << shift
+                    key >>= TAG_BITS
+                    shift += TAG_BITS
+                new_key |= words[key] << shift
+                mine[new_key] = mine.get(new_key, 0) + count
+        if self.max_entries is not None and self.size() > self.max_entries:
+            self._evict()
+
+counts5 = HashedNgramCounts(5, news_train, max_entries=1000000)
+counts5.size() # number of (context, tag) entries, at most max_entries (plus a little, if the
+               # unigram level alone is bigger than that)
+counts5.prune(min_count=2, threshold=1e-7)
+t5 = counts5.train()
+t5.evaluate(news_test) # compare with t3
+fast_t5 = FusedBackoffTagger(t5) # works for any number of levels
+
+# HashedNgramCounts(3, news_train).train() gives the same tagger as t3.
+# More text can be added at any time, and the size stays within max_entries:
+counts5.add(brown.tagged_sents(categories="editorial"))
+
+##-- An HMM tagger, decoding whole batches of sentences at once --##
+#
+#   - t3 decides each tag one word at a time and never goes back, so one bad
+#     guess can lead the next ones astray
+#   - a hidden Markov model (HMM) scores whole tag sequences instead:
+#       P(tag | previous tag) * P(word | tag), for every word of the sentence
+#     and the Viterbi algorithm finds the best sequence without trying all of
+#     them: at each word, it only keeps the best way to reach each tag
+#   - with tags and words replaced by integer ids, both tables are NumPy
+#     arrays (previous tag x tag, and word x tag), and one step of Viterbi
+#     looks at all the (previous tag, tag) pairs at once
+#   - sentences are sorted by length and decoded in batches of similar length
+#     (the shorter ones padded at the end), so one step also covers a whole
+#     batch of sentences
+#   - words not seen in training get the tags of the words that were seen
+#     only once (mostly nouns, proper nouns and adjectives)
+#   - tag(), tag_sents() and evaluate() work like t3's
+
+class HMMTagger(object):
+
+    def __init__(self, tagged_sents, smoothing=0.1, batch_size=64):
+        tagged_sents = list(tagged_sents) # read three times below
+        self.batch_size = batch_size
+        self.id2tag = sorted(set(tag for sent in tagged_sents for (word, tag) in sent))
+        self.tag_index = dict((t, i) for i, t in enumerate(self.id2tag))
+        word_counts = nltk.FreqDist(word for sent in tagged_sents for (word, tag) in sent)
+        self.id2word = sorted(word_counts)
+        self.word_index = dict((w, i) for i, w in enumerate(self.id2word))
+        n_tags, n_words = len(self.id2tag), len(self.id2word)
+
+        # row n_tags of transitions is the start of a sentence, column n_tags the end
+        transitions = np.zeros((n_tags + 1, n_tags + 1))
+        emissions = np.zeros((n_words + 1, n_tags)) # row n_words: unknown words
+        for sent in tagged_sents:
+            prev = n_tags
+            for word, tag in sent:
+                t = self.tag_index[tag]
+                transitions[prev, t] += 1
+                emissions[self.word_index[word], t] += 1
+                if word_counts[word] == 1:
+                    emissions[n_words, t] += 1
+                prev = t
+            transitions[prev, n_tags] += 1
+
+        transitions += smoothing
+        transitions /= transitions.sum(axis=1)[:, None]
+        tag_totals = emissions[:n_words].sum(axis=0)
+        emissions[n_words] += smoothing
+        with np.errstate(divide='ignore'):
+            # log-probabilities, so that multiplying becomes adding (and never underflows)
+            transitions = np.log(transitions).astype(np.float32)
+            self.emissions = np.log(emissions / tag_totals).astype(np.float32)
+        self.start = transitions[n_tags, :n_tags]
+        self.end = transitions[:n_tags, n_tags]
+        self.transitions = transitions[:n_tags, :n_tags]
+
+    def _viterbi(self, word_ids, lengths):
+        # word_ids: batch x longest sentence (padded), lengths: batch
+        batch, longest = word_ids.shape
+        scores = self.start + self.emissions[word_ids[:, 0]] # batch x tags
+        back = np.zeros((batch, longest, len(self.id2tag)), dtype=np.int32)
+        for i in range(1, longest):
+            candidates = scores[:, :, None] + self.transitions # batch x previous tag x tag
+            back[:, i] = candidates.argmax(axis=1)
+            new_scores = candidates.max(axis=1) + self.emissions[word_ids[:, i]]
+            active = (i < lengths)[:, None] # the sentences that haven't ended yet
+            scores = np.where(active, new_scores, scores)
+        best = (scores + self.end).argmax(axis=1)
+        paths = []
+        for b in range(batch):
+            tag = best[b]
+            path = [tag]
+            for i in range(lengths[b] - 1, 0, -1):
+                tag = back[b, i, tag]
+                path.append(tag)
+            path.reverse()
+            paths.append(path)
+        return paths
+
+    def tag_sents(self, sentences):
+        sentences = [list(sent) for sent in sentences]
+        unknown = len(self.id2word)
+        order = sorted(range(len(sentences)), key=lambda s: len(sentences[s]))
+        order = [s for s in order if sentences[s]] # nothing to do for empty sentences
+        results = [[] for sent in sentences]
+        for lo in range(0, len(order), self.batch_size):
+            batch = order[lo:lo + self.batch_size]
+            lengths = np.array([len(sentences[s]) for s in batch])
+            word_ids = np.full((len(batch), lengths.max()), unknown, dtype=np.int32)
+            for b, s in enumerate(batch):
+                word_ids[b, :lengths[b]] = [self.word_index.get(w, unknown) for w in sentences[s]]
+            for s, path in zip(batch, self._viterbi(word_ids, lengths)):
+                results[s] = [(w, self.id2tag[t]) for w, t in zip(sentences[s], path)]
+        return results
+
+    def tag(self, tokens):
+        return self.tag_sents([tokens])[0]
+
+    def evaluate(self, gold):
+        gold = list(gold)
+        tagged = self.tag_sents([[word for (word, tag) in sent] for sent in gold])
+        correct = total = 0
+        for tagged_sent, gold_sent in zip(tagged, gold):
+            for (word, tag), (gold_word, gold_tag) in zip(tagged_sent, gold_sent):
+                correct += (tag == gold_tag)
+                total += 1
+        return float(correct) / total
+
+hmm = HMMTagger(news_train) # a few seconds
+hmm.tag(brown.sents()[3])
+hmm.evaluate(news_test) # compare with t3.evaluate(news_test)
+
+start = time.time(); hmm.tag_sents(news_sents); seconds = time.time() - start
+len(brown.words(categories="news")) / seconds # tokens per second, compare with t3 and fast_t3
+
 
 ## - - - - - - - - - -  ##
 ## 5.5. Storing Taggers ##
@@ -318,6 +1944,141 @@ from pickle import load
 with open('t3.pkl', 'rb') as input:
     t3 = load(input)
 
+##-- A compact file format for n-gram taggers --##
+#
+#   - load() has to rebuild every dictionary and tuple of t3 before the
+#     first word can be tagged, and each process gets its own copy
+#   - instead, we can write the tables of the fused tagger (see 5.4) into a
+#     binary file, in the same way as the cmudict store in section 1:
+#       header (with a version number) | tags | sorted words |
+#       word -> record offsets | records
+#   - each record is one (level, # previous tags, previous tag ids, tag id)
+#     entry of the backoff chain, all stored as small integers
+#   - the file is memory-mapped, so opening it is instant and forked worker
+#     processes share the same pages; a word's records are only decoded the
+#     first time the word is tagged, and only the cache_size most recently
+#     used words are kept decoded (words not in the table are not kept at all)
+
+TAGGER_MAGIC = b'NGTG'
+TAGGER_VERSION = 1
+TAGGER_HEADER = struct.Struct('<4sIIIIIi') # magic, version, #tags, #words, #records, history, default tag
+
+def save_ngram_tagger(tagger, path):
+    fused = tagger if isinstance(tagger, FusedBackoffTagger) else FusedBackoffTagger(tagger)
+    if fused.fallback is not None:
+        raise ValueError('only n-gram and default taggers can be stored')
+    n = fused.history
+    record = struct.Struct('<BBB%dHH' % n)
+
+    tags = set([fused.default]) if fused.default is not None else set()
+    for ngrams, unigram in fused.table.values():
+        for k, contexts in ngrams:
+            for tag_context, tag in contexts.items():
+                tags.update(tag_context)
+                tags.add(tag)
+        if unigram is not None:
+            tags.add(unigram)
+    tags = sorted(tags)
+    if len(tags) > 65535:
+        raise ValueError('too many distinct tags')
+    tag_ids = dict((tag, i) for i, tag in enumerate(tags))
+
+    words = sorted(fused.table, key=lambda w: w.encode('utf-8'))
+    record_offsets, records = [0], []
+    for word in words:
+        ngrams, unigram = fused.table[word]
+        levels = [(k, contexts) for k, contexts in ngrams]
+        if unigram is not None:
+            levels.append((0, {(): unigram}))
+        for level, (k, contexts) in enumerate(levels):
+            for tag_context, tag in contexts.items():
+                ids = [tag_ids[t] for t in tag_context]
+                records.append(record.pack(level, k, len(ids), *(ids + [0] * (n - len(ids)) + [tag_ids[tag]])))
+        record_offsets.append(len(records))
+
+    tag_blob = '\n'.join(tags).encode('utf-8')
+    default = tag_ids[fused.default] if fused.default is not None else -1
+    with open(path, 'wb') as output:
+        output.write(TAGGER_HEADER.pack(TAGGER_MAGIC, TAGGER_VERSION, len(tags),
+                                        len(words), len(records), n, default))
+        output.write(struct.pack('<I', len(tag_blob)) + tag_blob)
+        output.write(pack_word_table(words))
+        output.write(struct.pack('<%dI' % len(record_offsets), *record_offsets))
+        output.write(b''.join(records))
+
+class MappedTaggerTable(MappedFile):
+    # behaves like the table of a FusedBackoffTagger: table.get(word)
+
+    def __init__(self, path, cache_size=10000):
+        with open(path, 'rb') as input:
+            self.buf = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_tags, n_words, n_records, n, default = TAGGER_HEADER.unpack_from(self.buf, 0)
+        if magic != TAGGER_MAGIC or version != TAGGER_VERSION:
+            raise ValueError('%s is not a version %d tagger file' % (path, TAGGER_VERSION))
+        pos = TAGGER_HEADER.size
+        (tag_len,) = struct.unpack_from('<I', self.buf, pos)
+        pos += 4
+        self.tags = self.buf[pos:pos + tag_len].decode('utf-8').split('\n')
+        pos += tag_len
+        self.history = n
+        self.default = self.tags[default] if default >= 0 else None
+        self.record = struct.Struct('<BBB%dHH' % n)
+        self.n_words = n_words
+        self.word_offsets = pos
+        pos += 4 * (n_words + 1)
+        self.word_blob = pos
+        pos += self._int(self.word_offsets, n_words)
+        self.record_offsets = pos
+        pos += 4 * (n_words + 1)
+        self.records = pos
+        self.cache_size = cache_size
+        self.decoded = OrderedDict() # word -> (ngrams, unigram), oldest first
+
+    def get(self, word, default=None):
+        entry = self.decoded.pop(word, None)
+        if entry is None:
+            entry = self._decode(word)
+            if entry is None:
+                return default
+        self.decoded[word] = entry # now the most recently used
+        if len(self.decoded) > self.cache_size:
+            self.decoded.popitem(last=False)
+        return entry
+
+    def _decode(self, word):
+        i = self._find(word)
+        if i is None:
+            return None
+        tags, size = self.tags, self.record.size
+        levels = {}
+        for r in range(self._int(self.record_offsets, i), self._int(self.record_offsets, i + 1)):
+            fields = self.record.unpack_from(self.buf, self.records + r * size)
+            level, k, length = fields[:3]
+            tag_context = tuple(tags[t] for t in fields[3:3 + length])
+            levels.setdefault(level, (k, {}))[1][tag_context] = tags[fields[-1]]
+        ngrams, unigram = [], None
+        for level in sorted(levels):
+            k, contexts = levels[level]
+            if k == 0:
+                unigram = contexts[()]
+            else:
+                ngrams.append((k, contexts))
+        return ngrams, unigram
+
+class MappedBackoffTagger(FusedBackoffTagger):
+
+    def __init__(self, path, cache_size=10000):
+        self.table = MappedTaggerTable(path, cache_size)
+        self.default = self.table.default
+        self.fallback = None
+        self.history = self.table.history
+
+save_ngram_tagger(t3, 't3.bin')
+
+# In a different Python session (or in every worker process):
+t3_mapped = MappedBackoffTagger('t3.bin') # opens right away
+t3_mapped.tag(brown.sents()[3]) == t3.tag(brown.sents()[3]) # True
+
 
 ## - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ##
 ## 5.6. Inspecting tagger performance - nltk.ConfusionMatrix() ##
@@ -337,6 +2098,139 @@ print(cm.pp(sort_by_count=True, show_percents=True, truncate=10))
 # print(cm.pretty_format(sort_by_count=True, truncate=10))
 # print(cm.pretty_format(sort_by_count=True, show_percents=True, truncate=10))
 
+##-- Counting the confusions in parallel, without the tag lists --##
+#
+#   - test_tags and gold_tags above hold one string per word of the whole
+#     corpus (twice), and all of the tagging happens on one core
+#   - but the confusion matrix only needs to know how many times each
+#     (gold tag, test tag) pair occurs
+#   - so we can split the corpus files into shards, let each process tag its
+#     shard and count the pairs as it goes, and then add up the counts
+
+class ConfusionCounts(object):
+
+    def __init__(self):
+        self.counts = {} # gold tag -> {test tag: count}
+
+    def add(self, gold, test):
+        row = self.counts.get(gold)
+        if row is None:
+            row = self.counts[gold] = {}
+        row[test] = row.get(test, 0) + 1
+
+    def update(self, counts):
+        for gold, row in counts.items():
+            mine = self.counts.setdefault(gold, {})
+            for test, count in row.items():
+                mine[test] = mine.get(test, 0) + count
+
+    def total(self):
+        return sum(sum(row.values()) for row in self.counts.values())
+
+    def accuracy(self):
+        correct = sum(row.get(gold, 0) for gold, row in self.counts.items())
+        return float(correct) / self.total()
+
+    def pretty_format(self, show_percents=False, values_in_chart=True,
+                      truncate=None, sort_by_count=False):
+        # the same report as nltk.ConfusionMatrix.pretty_format()
+        values = set(self.counts)
+        for row in self.counts.values():
+            values.update(row)
+        values = sorted(values)
+        if sort_by_count:
+            values = sorted(values, key=lambda v: -sum(self.counts.get(v, {}).values()))
+        if truncate:
+            values = values[:truncate]
+        total = self.total()
+        max_conf = max(max(row.values()) for row in self.counts.values())
+
+        if values_in_chart:
+            value_strings = ['%s' % val for val in values]
+        else:
+            value_strings = [str(n + 1) for n in range(len(values))]
+        valuelen = max(len(val) for val in value_strings)
+        value_format = '%' + repr(valuelen) + 's | '
+        if show_percents:
+            entrylen = 6
+            entry_format = '%5.1f%%'
+            zerostr = '     .'
+        else:
+            entrylen = len(repr(max_conf))
+            entry_format = '%' + repr(entrylen) + 'd'
+            zerostr = ' ' * (entrylen - 1) + '.'
+
+        s = ''
+        for i in range(valuelen):
+            s += (' ' * valuelen) + ' |'
+            for val in value_strings:
+                if i >= valuelen - len(val):
+                    s += val[i - valuelen + len(val)].rjust(entrylen + 1)
+                else:
+                    s += ' ' * (entrylen + 1)
+            s += ' |\n'
+        s += '%s-+-%s+\n' % ('-' * valuelen, '-' * ((entrylen + 1) * len(values)))
+        for val, gold in zip(value_strings, values):
+            s += value_format % val
+            row = self.counts.get(gold, {})
+            for test in values:
+                count = row.get(test, 0)
+                if count == 0:
+                    s += zerostr
+                elif show_percents:
+                    s += entry_format % (100.0 * count / total)
+                else:
+                    s += entry_format % count
+                if gold == test:
+                    prevspace = s.rfind(' ')
+                    s = s[:prevspace] + '<' + s[prevspace + 1:] + '>'
+                else:
+                    s += ' '
+            s += '|\n'
+        s += '%s-+-%s+\n' % ('-' * valuelen, '-' * ((entrylen + 1) * len(values)))
+        s += '(row = reference; col = test)\n'
+        if not values_in_chart:
+            s += 'Value key:\n'
+            for i, value in enumerate(values):
+                s += '%6d: %s\n' % (i + 1, value)
+        return s
+
+    pp = pretty_format # the older (Python 2 / NLTK 2) name
+
+def _init_confusion_worker(tagger, corpus):
+    global _worker_tagger, _worker_corpus
+    _worker_tagger, _worker_corpus = tagger, corpus
+
+def _count_confusions(fileids):
+    cm = ConfusionCounts()
+    for sent in _worker_corpus.tagged_sents(fileids):
+        tagged = _worker_tagger.tag([word for (word, tag) in sent])
+        for (word, gold), (tagged_word, test) in zip(sent, tagged):
+            cm.add(gold, test)
+    return cm.counts
+
+def parallel_confusion(tagger, corpus, fileids=None, processes=None, shard_size=10):
+    if fileids is None:
+        fileids = corpus.fileids()
+    shards = [fileids[i:i + shard_size] for i in range(0, len(fileids), shard_size)]
+    cm = ConfusionCounts()
+    pool = Pool(processes, _init_confusion_worker, (tagger, corpus))
+    try:
+        for counts in pool.imap_unordered(_count_confusions, shards):
+            cm.update(counts)
+    finally:
+        pool.close()
+        pool.join()
+    return cm
+
+# NOTE: on Windows and macOS, see the note on worker processes in section 2
+
+cm = parallel_confusion(t3, brown) # all cores by default
+print(cm.pretty_format(sort_by_count=True, truncate=10)) # same report as above
+print(cm.pretty_format(sort_by_count=True, show_percents=True, truncate=10))
+
+cm = parallel_confusion(fast_t3, brown, brown.fileids(categories="news"))
+
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ###
 ### 6. Mini-examples of NLTK application ###
@@ -361,6 +2255,45 @@ len(compound_nouns)
 for c in compound_nouns[:20]:
     print(c)
 
+##-- Scanning the whole corpus at once (with NumPy) --##
+#
+#   - process2() looks at every pair of words one by one in Python, and
+#     compound_nouns keeps growing with every sentence
+#   - if each word and each tag is replaced by an integer id, the corpus
+#     becomes two long arrays, plus the positions where each sentence starts
+#     (EncodedTaggedCorpus, or a cached corpus, from section 1)
+#   - then "is this tag a noun?" can be asked for every position at once, and
+#     position i starts a compound if both i and i+1 are nouns, and i is not
+#     the last word of its sentence
+#   - the result can be counted without a list of pairs, or produced one pair
+#     at a time
+#   - requires NumPy (http://www.numpy.org)
+
+def count_compounds(corpus, first_tags=('NN', 'NNS'), second_tags=('NN', 'NNS')):
+    positions = corpus.pair_positions(first_tags, second_tags)
+    n_words = len(corpus.id2word)
+    codes = corpus.word_ids[positions].astype(np.int64) * n_words + corpus.word_ids[positions + 1]
+    codes, counts = np.unique(codes, return_counts=True)
+    words = corpus.id2word
+    return nltk.FreqDist(dict(((words[c // n_words], words[c % n_words]), int(n))
+                              for c, n in zip(codes.tolist(), counts)))
+
+def iter_compounds(corpus, first_tags=('NN', 'NNS'), second_tags=('NN', 'NNS')):
+    words, word_ids = corpus.id2word, corpus.word_ids
+    for i in corpus.pair_positions(first_tags, second_tags).tolist():
+        yield words[word_ids[i]], words[word_ids[i + 1]]
+
+encoded_brown = EncodedTaggedCorpus(brown.tagged_sents()) # the slow part, done once
+
+compounds = count_compounds(encoded_brown) # the scan itself takes a fraction of a second
+compounds.N() == len(compound_nouns) # True
+compounds.most_common(10)
+count_compounds(cached_brown) # the cached corpus from section 1 works too, with no parsing at all
+
+for c in iter_compounds(encoded_brown):
+    print(c) # same pairs, in the same order, as compound_nouns
+    break
+
 
 ## - - - - - - - - - - - - - - - - - - -  ##
 ## 6.2. Extracting [N that V N N] phrases ##
@@ -391,6 +2324,110 @@ for tagged_sent in brown.tagged_sents():
 # flower that smiles today tomorrow
 # hands that circled Matsuo's wrist
 
+##-- Looking for many tag patterns at once --##
+#
+#   - process5() makes a 5-tuple for every position of every sentence, and
+#     a second pattern would mean a second function and a second pass
+#   - instead, patterns can be written as a short string of word/tag slots:
+#       */N*    any word, tag starting with N
+#       that    the word "that", any tag (same as that/*)
+#       */VBD   any word, tag VBD
+#       *       anything
+#     e.g. [N that V N N] is  '*/N* that */V* */N* */N*'
+#   - all the patterns are put into one tree of slots (patterns that begin
+#     with the same slots share them), and each sentence is read once: at
+#     every word we follow the branches that the word matches, starting from
+#     the beginning of the tree or from where the previous word left off
+#   - each match comes out as (pattern id, sentence number, start, end)
+
+def _slot_spec(spec):
+    if spec == '*':
+        return None # anything
+    if spec.endswith('*'):
+        return ('prefix', spec[:-1])
+    return ('exact', spec)
+
+def _slot_matches(spec, value):
+    if spec is None:
+        return True
+    if value is None:
+        return False
+    if spec[0] == 'prefix':
+        return value.startswith(spec[1])
+    return value == spec[1]
+
+class _SlotNode(object):
+
+    def __init__(self):
+        self.children = {} # (word spec, tag spec) -> _SlotNode
+        self.by_word = {}  # exact word -> [(tag spec, node), ...]
+        self.others = []   # [(word spec, tag spec, node), ...]
+        self.pattern_ids = [] # patterns that end here
+
+    def child(self, word_spec, tag_spec):
+        key = (word_spec, tag_spec)
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = _SlotNode()
+            if word_spec is not None and word_spec[0] == 'exact':
+                self.by_word.setdefault(word_spec[1], []).append((tag_spec, node))
+            else:
+                self.others.append((word_spec, tag_spec, node))
+        return node
+
+    def step(self, word, tag):
+        for tag_spec, node in self.by_word.get(word, ()):
+            if _slot_matches(tag_spec, tag):
+                yield node
+        for word_spec, tag_spec, node in self.others:
+            if _slot_matches(word_spec, word) and _slot_matches(tag_spec, tag):
+                yield node
+
+class TagPatternMatcher(object):
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.root = _SlotNode()
+        for pattern_id, pattern in enumerate(self.patterns):
+            node = self.root
+            for slot in pattern.split():
+                word, sep, tag = slot.rpartition('/')
+                if not sep:
+                    word, tag = slot, '*'
+                node = node.child(_slot_spec(word), _slot_spec(tag))
+            node.pattern_ids.append(pattern_id)
+
+    def finditer(self, sentence):
+        active = [] # (node, start) for every partial match so far
+        for i, (word, tag) in enumerate(sentence):
+            active.append((self.root, i))
+            next_active = []
+            for node, start in active:
+                for next_node in node.step(word, tag):
+                    for pattern_id in next_node.pattern_ids:
+                        yield pattern_id, start, i + 1
+                    if next_node.children:
+                        next_active.append((next_node, start))
+            active = next_active
+
+    def scan(self, tagged_sents):
+        for sent_no, sentence in enumerate(tagged_sents):
+            for pattern_id, start, end in self.finditer(sentence):
+                yield pattern_id, sent_no, start, end
+
+matcher = TagPatternMatcher([
+    '*/N* that */V* */N* */N*',   # 0: [N that V N N], as in process5()
+    '*/N* that */V* */AT */N*',   # 1: [N that V the N]
+    '*/JJ */NN */NN',             # 2: [Adj N N]
+    '*/MD */BE */VBN',            # 3: passive with a modal, e.g. "will be sold"
+])
+
+tagged_sents = brown.tagged_sents()
+for pattern_id, sent_no, start, end in matcher.scan(tagged_sents):
+    if pattern_id == 0:
+        print(' '.join(word for (word, tag) in tagged_sents[sent_no][start:end]))
+# same phrases as process5()
+
 
 ## - - - - - - - - - - - - - - - - - - - - - - - - -  ##
 ## 6.3. Extracting the rhyme of a word (with cmudict) ##
@@ -420,11 +2457,428 @@ def get_perfect_rhyme(word):
 get_perfect_rhyme('caravan')
 get_perfect_rhyme('winnebago')
 
+##-- A precomputed rhyme index --##
+#
+#   - get_perfect_rhyme() above searches a list of 130,000+ words and rebuilds
+#     cmudict.dict() every time it is called, which is fine for a few words
+#     but far too slow for rhyming thousands of line endings
+#   - instead, we can go through cmudict once and store:
+#       word -> rhyme key (the rhyme from the last stressed vowel on)
+#       rhyme key -> all words that share it
+#   - after that, every lookup is a single dictionary access
+
+def rhyme_key(pronun):
+    # same rule as get_perfect_rhyme(): start at the last primary-stressed phoneme
+    stressed_pos = None
+    for i in range(len(pronun)):
+        if '1' in pronun[i]:
+            stressed_pos = i
+    if stressed_pos is None:
+        return None
+    return tuple(pronun[stressed_pos:])
+
+class RhymeIndex(object):
+
+    def __init__(self, entries):
+        # entries: (word, pronunciation) pairs, e.g. cmudict.entries()
+        self.word2key = {}
+        self.key2words = {}
+        for word, pronun in entries:
+            key = rhyme_key(pronun)
+            if word not in self.word2key:
+                # like cmudict.dict()[word][0], the first pronunciation wins
+                self.word2key[word] = key
+            if key is not None:
+                self.key2words.setdefault(key, set()).add(word)
+        for key in self.key2words:
+            self.key2words[key] = tuple(sorted(self.key2words[key]))
+
+    def get_perfect_rhyme(self, word):
+        key = self.word2key.get(word.lower())
+        if key is None:
+            return None # not in cmudict, or not rhymable
+        return list(key)
+
+    def get_perfect_rhymes(self, words):
+        return [self.get_perfect_rhyme(word) for word in words]
+
+    def find_rhymes(self, word):
+        word = word.lower()
+        key = self.word2key.get(word)
+        if key is None:
+            return []
+        return [w for w in self.key2words[key] if w != word]
+
+    def save(self, path):
+        with open(path, 'wb') as output:
+            dump(self, output, -1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as input:
+            return load(input)
+
+rhymes = RhymeIndex(cmudict.entries()) # takes a few seconds, but only once
+# rhymes = RhymeIndex(prons.entries()) # or build it from the shared store in section 1
+rhymes.get_perfect_rhyme('caravan')
+# Returns: ['EH1', 'R', 'AH0', 'V', 'AE2', 'N'] (same as get_perfect_rhyme('caravan'))
+rhymes.get_perfect_rhymes(['caravan', 'winnebago', 'xyzzy'])
+# Returns: [['EH1', 'R', 'AH0', 'V', 'AE2', 'N'], ['EY1', 'G', 'OW0'], None]
+rhymes.find_rhymes('caravan')[:5]
+
+# The index can be stored and loaded back like the taggers in section 5.5:
+rhymes.save('rhymes.pkl')
+rhymes = RhymeIndex.load('rhymes.pkl')
+
 
 ## - - - - - - - - - - - - - - - - - - - - - - - - - ##
 ## 6.4. Poetry generation using POS tags and bigrams ##
 ## - - - - - - - - - - - - - - - - - - - - - - - - - ##
-# (Separate file/demo not included here)
+#
+#   - a line is a walk from word to word: the next word is drawn according
+#     to how often it followed the previous (word, tag) in a tagged corpus
+#     (e.g. brown, or the poetry corpus in section 7)
+#   - now and then (creativity = how often), the next tag is drawn from the
+#     tag bigrams instead, and then any word with that tag: the line stays
+#     grammatical-ish, but goes where the corpus never went
+#   - all the transitions are stored in a few flat arrays of numbers:
+#       row_start[a] ... row_start[a+1]   where the transitions of a are
+#       targets                           what follows a
+#     and for each row an "alias table", so that a draw takes the same short
+#     time however many words can follow (http://www.keithschwarz.com/darts-dice-coins/):
+#     pick one column at random, then either keep it or take its alias
+#   - optionally (with a pronunciation dictionary, e.g. get_cmudict() from
+#     section 0): lines with a given number of syllables, and lines that end
+#     with a rhyme (a rhyming line is made backwards, starting from its last word)
+
+import random
+
+def _alias_row(weights):
+    # Vose's method: column i is kept with probability keep[i], otherwise it becomes alias[i]
+    n, total = len(weights), float(sum(weights))
+    scaled = [w * n / total for w in weights]
+    keep, alias = [1.0] * n, list(range(n))
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        keep[s], alias[s] = scaled[s], l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    return keep, alias
+
+class TransitionTable(object):
+
+    def __init__(self, counts, n_states):
+        # counts: {(from state, to state): count}, states numbered 0 ... n_states-1
+        rows = [[] for _ in range(n_states)]
+        for (a, b), count in counts.items():
+            rows[a].append((b, count))
+        self.row_start = array('i', [0])
+        self.targets, self.alias, self.keep = array('i'), array('i'), array('d')
+        for row in rows:
+            row.sort()
+            start = len(self.targets)
+            keep, alias = _alias_row([count for (b, count) in row])
+            self.targets.extend(b for (b, count) in row)
+            self.alias.extend(start + i for i in alias)
+            self.keep.extend(keep)
+            self.row_start.append(len(self.targets))
+
+    def draw(self, state):
+        start = self.row_start[state]
+        x = random.random() * (self.row_start[state + 1] - start)
+        k = start + int(x)
+        if x - int(x) < self.keep[k]:
+            return self.targets[k]
+        return self.targets[self.alias[k]]
+
+def count_syllables(word, pronunciations=None):
+    if pronunciations is not None and word.lower() in pronunciations:
+        return sum(1 for phone in pronunciations[word.lower()][0] if phone[-1].isdigit())
+    return len(re.findall(r'[aeiouy]+', word.lower())) # a guess, for words not in the dictionary
+
+class PoetryGenerator(object):
+
+    def __init__(self, tagged_sents, pronunciations=None, creativity=0.2):
+        self.creativity = creativity
+        self.id2token = [None] # 0 is the start/end of a line
+        self.id2tag = [None]
+        token_index, tag_index = {}, {}
+        word_counts, tag_counts, emissions = {}, {}, {}
+        for sentence in tagged_sents:
+            prev, prev_tag = 0, 0
+            for token in sentence:
+                i = token_index.get(token)
+                if i is None:
+                    i = token_index[token] = len(self.id2token)
+                    self.id2token.append(token)
+                t = tag_index.get(token[1])
+                if t is None:
+                    t = tag_index[token[1]] = len(self.id2tag)
+                    self.id2tag.append(token[1])
+                word_counts[prev, i] = word_counts.get((prev, i), 0) + 1
+                tag_counts[prev_tag, t] = tag_counts.get((prev_tag, t), 0) + 1
+                emissions[t, i] = emissions.get((t, i), 0) + 1
+                prev, prev_tag = i, t
+            if prev:
+                word_counts[prev, 0] = word_counts.get((prev, 0), 0) + 1
+                tag_counts[prev_tag, 0] = tag_counts.get((prev_tag, 0), 0) + 1
+        emissions[0, 0] = 1 # the end of a line is its own "word"
+        n, n_tags = len(self.id2token), len(self.id2tag)
+        self.token_tag = array('i', [0] + [tag_index[tag] for (word, tag) in self.id2token[1:]])
+        self.forward = TransitionTable(word_counts, n)
+        self.backward = TransitionTable(dict(((b, a), c) for (a, b), c in word_counts.items()), n)
+        self.tag_forward = TransitionTable(tag_counts, n_tags)
+        self.tag_backward = TransitionTable(dict(((b, a), c) for (a, b), c in tag_counts.items()), n_tags)
+        self.emissions = TransitionTable(emissions, n_tags)
+
+        self.syllables = None
+        self.rhymes = {} # rhyme (see rhyme_key() in 6.3) -> ids of the words with that rhyme
+        if pronunciations is not None:
+            self.syllables = array('i', [0] + [count_syllables(word, pronunciations)
+                                               for (word, tag) in self.id2token[1:]])
+            for i in range(1, n):
+                word = self.id2token[i][0].lower()
+                if word in pronunciations:
+                    key = rhyme_key(pronunciations[word][0])
+                    if key is not None:
+                        self.rhymes.setdefault(key, []).append(i)
+        self.pronunciations = pronunciations
+
+    def _walk(self, start, words, tags, max_words):
+        # the ids of a line, from start (not included) until the start/end of a line
+        line = []
+        token_tag = self.token_tag
+        i = start
+        while len(line) < max_words:
+            if random.random() < self.creativity:
+                i = self.emissions.draw(tags.draw(token_tag[i]))
+            else:
+                i = words.draw(i)
+            if i == 0:
+                return line
+            line.append(i)
+        return None # too long
+
+    def _line(self, syllables, rhyme, max_words):
+        if rhyme is None:
+            line = self._walk(0, self.forward, self.tag_forward, max_words)
+        else:
+            last = random.choice(self.rhymes[rhyme])
+            line = self._walk(last, self.backward, self.tag_backward, max_words - 1)
+            if line is not None:
+                line.reverse()
+                line.append(last)
+        if not line:
+            return None
+        if syllables is not None and sum(self.syllables[i] for i in line) != syllables:
+            return None
+        return ' '.join(self.id2token[i][0] for i in line)
+
+    def _rhyme(self, word):
+        pronun = self.pronunciations.get(word.lower())
+        return pronun and rhyme_key(pronun[0])
+
+    def line(self, syllables=None, rhymes_with=None, max_words=15, tries=1000):
+        # returns None if no line was found within the number of tries
+        if (syllables is not None or rhymes_with is not None) and self.pronunciations is None:
+            raise ValueError('syllables and rhymes need a pronunciation dictionary')
+        rhyme = None
+        if rhymes_with is not None:
+            rhyme = self._rhyme(rhymes_with)
+            if rhyme not in self.rhymes:
+                return None # nothing in the corpus rhymes with it
+        for _ in range(tries):
+            line = self._line(syllables, rhyme, max_words)
+            if line is not None:
+                return line
+        return None
+
+    def stanza(self, scheme='AABB', syllables=None, max_words=15, tries=100):
+        # lines with the same letter in the scheme rhyme with each other
+        if self.pronunciations is None:
+            raise ValueError('syllables and rhymes need a pronunciation dictionary')
+        lines, rhymes = [], {}
+        for letter in scheme:
+            for _ in range(tries):
+                line = self.line(syllables, rhymes.get(letter), max_words)
+                # the first line of a letter has to end with a word that other words rhyme with
+                if line is None or letter in rhymes or self._rhyme(line.split()[-1]) in self.rhymes:
+                    break
+            if line is None:
+                return None
+            rhymes.setdefault(letter, line.split()[-1])
+            lines.append(line)
+        return '\n'.join(lines)
+
+poet = PoetryGenerator(brown.tagged_sents(categories='romance')) # a few seconds
+poet.line()
+
+poet = PoetryGenerator(brown.tagged_sents(categories='romance'), get_cmudict())
+poet.line(syllables=10)
+poet.line(rhymes_with='caravan')
+print(poet.stanza('ABAB', syllables=8))
+
+start = time.time(); lines = [poet.line() for i in range(10000)]; time.time() - start
+# thousands of lines per second (fewer with syllable counts, since the lines that don't
+# fit are thrown away and made again)
+
+# poet = PoetryGenerator(poetry.tagged_sents(), get_cmudict()) # with the corpus from section 7
+
+
+## - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ##
+## 6.5. Putting it together: tokenize, tag, extract and count  ##
+## - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ##
+#
+#   - the examples above keep a whole list at every step (all the tokens, all
+#     the tagged sentences, all of compound_nouns), so memory grows with the
+#     size of the corpus
+#   - instead, every step can be a generator: it takes the items of the step
+#     before one batch at a time, and passes its results on as soon as the
+#     batch is done
+#   - a step can also run in worker processes; it never has more than
+#     max_pending batches waiting for the workers, so a slow step makes the
+#     steps before it wait instead of piling up their results (Pool.imap()
+#     would read its whole input in the meantime)
+#   - only a few batches per step are in memory at any time, however big the
+#     corpus is
+
+from collections import deque
+
+def _init_stage_worker(function):
+    global _worker_function
+    _worker_function = function
+
+def _run_stage(batch):
+    return _worker_function(batch)
+
+class Stage(object):
+
+    def __init__(self, function, batch_size=100, processes=0, max_pending=None):
+        # function: takes a list of items, returns a list of results
+        # (any number of results per item, e.g. all the compounds of a batch of sentences)
+        self.function = function
+        self.batch_size = batch_size
+        self.processes = processes # 0: run in this process
+        self.max_pending = max_pending or 2 * max(processes, 1)
+
+    def batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __call__(self, items):
+        if not self.processes:
+            for batch in self.batches(items):
+                for result in self.function(batch):
+                    yield result
+            return
+        pool = Pool(self.processes, _init_stage_worker, (self.function,))
+        pending = deque()
+        try:
+            for batch in self.batches(items):
+                pending.append(pool.apply_async(_run_stage, (batch,)))
+                if len(pending) >= self.max_pending: # wait before reading any more input
+                    for result in pending.popleft().get():
+                        yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+def pipeline(source, *stages):
+    stream = iter(source)
+    for stage in stages:
+        stream = stage(stream)
+    return stream
+
+## The steps (classes rather than functions, so that each one carries its settings,
+## e.g. the pattern, the tagger or the tags, along to the workers):
+
+def paragraphs(corpus, fileids=None):
+    # reads the files line by line, instead of corpus.raw(), and yields one paragraph at a time
+    for fileid in corpus.fileids() if fileids is None else fileids:
+        lines = []
+        stream = corpus.open(fileid)
+        try:
+            for line in stream:
+                if line.strip():
+                    lines.append(line)
+                elif lines:
+                    yield ''.join(lines)
+                    lines = []
+        finally:
+            stream.close()
+        if lines:
+            yield ''.join(lines)
+
+class Tokenize(object):
+
+    def __init__(self, pattern):
+        self.tokenizer = nltk.RegexpTokenizer(pattern)
+
+    def __call__(self, texts):
+        return [self.tokenizer.tokenize(text) for text in texts]
+
+class Tag(object):
+
+    def __init__(self, tagger):
+        self.tagger = tagger
+
+    def __call__(self, sents):
+        return self.tagger.tag_sents(sents)
+
+class ExtractCompounds(object):
+
+    def __init__(self, first_tags=('NN', 'NNS'), second_tags=('NN', 'NNS')):
+        self.first_tags = set(first_tags)
+        self.second_tags = set(second_tags)
+
+    def __call__(self, tagged_sents):
+        return [(w1, w2) for sentence in tagged_sents
+                for (w1, t1), (w2, t2) in zip(sentence, sentence[1:])
+                if t1 in self.first_tags and t2 in self.second_tags]
+
+class ExtractPatterns(object):
+
+    def __init__(self, matcher):
+        self.matcher = matcher # a TagPatternMatcher (section 6.2)
+
+    def __call__(self, tagged_sents):
+        return [(pattern_id, tuple(word for (word, tag) in sentence[start:end]))
+                for sentence in tagged_sents
+                for pattern_id, start, end in self.matcher.finditer(sentence)]
+
+# The last step is a counter: nltk.FreqDist() reads a generator one item at a time.
+
+compounds = nltk.FreqDist(pipeline(brown.tagged_sents(), Stage(ExtractCompounds(), 1000)))
+compounds.N() == len(compound_nouns) # True, without the list
+
+# Raw text, from the files to the counts (with tagging, the slowest step, on 3 cores):
+
+steps = [Stage(Tokenize(pattern), batch_size=500),
+         Stage(Tag(fast_t3), batch_size=200, processes=3),
+         Stage(ExtractCompounds(), batch_size=1000)]
+gutenberg_compounds = nltk.FreqDist(pipeline(paragraphs(gutenberg), *steps))
+gutenberg_compounds.most_common(10)
+
+# The same steps work with the other extractors:
+
+steps[-1] = Stage(ExtractPatterns(matcher), batch_size=1000)
+phrases = nltk.FreqDist(pipeline(paragraphs(gutenberg), *steps))
+
+# NOTE: on Windows and macOS, see the note on worker processes in section 2
 
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ ###
@@ -459,3 +2913,116 @@ poetry.paras()[1] # poetry.paras() returns all the poems, each a list of lines
 
 poetry.raw()[:100]
 poetry.words()[:50]
+
+##-- Indexing a corpus with thousands of files --##
+#
+#   - poetry.tagged_sents()[1000] has to read and parse the files one by one
+#     until it gets to sentence 1000, and it does that again in every session
+#   - if we know how many sentences each file has, sentence 1000 can be
+#     found with a binary search over the file offsets, and only that one file
+#     has to be read
+#   - the counting is done once, in parallel, and saved as an index (fileids,
+#     categories and number of sentences per file)
+#   - the index remembers when each file was last modified; files that have
+#     changed since (or are new) are counted again the next time
+
+CORPUS_INDEX_VERSION = 1
+
+def _init_index_worker(reader):
+    global _worker_reader
+    _worker_reader = reader
+
+def _count_file_sents(fileid):
+    return fileid, len(_worker_reader.tagged_sents(fileid))
+
+class IndexedCorpusReader(object):
+
+    def __init__(self, reader, index_path, processes=None):
+        self.reader = reader
+        files = {} # fileid -> (modification time, # sentences, categories)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as input:
+                saved = load(input)
+            if saved.get('version') == CORPUS_INDEX_VERSION:
+                files = saved['files']
+
+        fileids = reader.fileids()
+        mtimes = dict((f, os.path.getmtime(reader.abspath(f))) for f in fileids)
+        stale = [f for f in fileids if f not in files or files[f][0] != mtimes[f]]
+        if stale:
+            pool = Pool(processes, _init_index_worker, (reader,))
+            try:
+                for fileid, n_sents in pool.imap_unordered(_count_file_sents, stale, 20):
+                    files[fileid] = (mtimes[fileid], n_sents, reader.categories(fileid))
+            finally:
+                pool.close()
+                pool.join()
+        if stale or len(files) != len(fileids):
+            files = dict((f, files[f]) for f in fileids) # forget deleted files
+            with open(index_path, 'wb') as output:
+                dump({'version': CORPUS_INDEX_VERSION, 'files': files}, output, -1)
+
+        self._fileids = fileids
+        self._file_index = dict((f, i) for i, f in enumerate(fileids))
+        self._categories = [files[f][2] for f in fileids]
+        self.offsets = [0] # where each file starts, in sentences
+        for f in fileids:
+            self.offsets.append(self.offsets[-1] + files[f][1])
+        self._last = (None, None) # the most recently parsed file
+
+    def fileids(self, categories=None):
+        if categories is None:
+            return list(self._fileids)
+        if isinstance(categories, str):
+            categories = [categories]
+        return [f for f, cats in zip(self._fileids, self._categories)
+                if set(cats) & set(categories)]
+
+    def categories(self, fileids=None):
+        if fileids is None:
+            files = range(len(self._fileids))
+        else:
+            if isinstance(fileids, str):
+                fileids = [fileids]
+            files = [self._file_index[f] for f in fileids]
+        return sorted(set(cat for i in files for cat in self._categories[i]))
+
+    def _sent(self, i, tagged):
+        f = bisect.bisect_right(self.offsets, i) - 1
+        fileid = self._fileids[f]
+        if self._last[0] != fileid:
+            self._last = (fileid, list(self.reader.tagged_sents(fileid)))
+        sent = self._last[1][i - self.offsets[f]]
+        return sent if tagged else [word for (word, tag) in sent]
+
+    def _ranges(self, fileids, categories):
+        if fileids is None and categories is None:
+            return [(0, self.offsets[-1])]
+        if fileids is None:
+            fileids = self.fileids(categories)
+        elif isinstance(fileids, str):
+            fileids = [fileids]
+        files = [self._file_index[f] for f in fileids]
+        return [(self.offsets[i], self.offsets[i + 1]) for i in files]
+
+    def tagged_sents(self, fileids=None, categories=None):
+        return _RangeView(self._ranges(fileids, categories), lambda i: self._sent(i, True))
+
+    def sents(self, fileids=None, categories=None):
+        return _RangeView(self._ranges(fileids, categories), lambda i: self._sent(i, False))
+
+    def __getattr__(self, name):
+        # everything else (raw, words, paras, ...) comes from the original reader
+        if name == 'reader' or name.startswith('__'):
+            # not set yet (e.g. while pickle or copy rebuilds the object)
+            raise AttributeError(name)
+        return getattr(self.reader, name)
+
+# NOTE: on Windows and macOS, see the note on worker processes in section 2
+
+indexed_poetry = IndexedCorpusReader(poetry, corpus_dir + 'index.pkl') # counts all files once
+indexed_poetry.tagged_sents()[1000] # same as poetry.tagged_sents()[1000], but reads only one file
+len(indexed_poetry.sents(categories=poetry.categories()[0]))
+
+# In a later session, only the files that have changed are read again:
+indexed_poetry = IndexedCorpusReader(poetry, corpus_dir + 'index.pkl')
@@ -14,6 +14,7 @@
 ###     2.5. Anchors
 ###     2.6. Assertions
 ###     2.7. re.compile()
+###     2.8. Catastrophic backtracking
 ### 3. References and tools
 ################
 
@@ -394,6 +395,401 @@ for verb in motion_verbs:
 inflected_verbs
 # Returns: ['walked', 'moseyed', 'scurrying']
 
+## >> 2.7.1. Many keywords in one search string <<
+# The loop above compiles a new regex and searches the whole text once for each verb.
+# That's fine for three verbs, but with a list of thousands of words it gets very slow.
+# Instead, we can put all of the keywords into one search string.
+# Keywords often start the same way (e.g. "walk", "wander", "wade"), so the keywords are
+# first put into a tree of letters (a "trie"), and the search string follows that tree:
+
+def trie_regex(keywords):
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = True   # a keyword ends here
+    return _trie_to_regex(trie)
+
+def _trie_to_regex(node):
+    branches = [re.escape(char) + _trie_to_regex(node[char]) for char in sorted(node) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+    group = '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        group += '?'   # a keyword could also end before this group
+    return group
+
+trie_regex(["walk", "wander", "wade", "mosey"])
+# Returns: '(?:mosey|wa(?:de|lk|nder))'
+
+# The search then goes through the text only once, and for every word found we can
+# look up which keyword it starts with (the longest one, if more than one fits):
+
+class KeywordMatcher(object):
+
+    def __init__(self, keywords):
+        self.keywords = set(keywords)
+        self.lengths = sorted(set(len(k) for k in self.keywords), reverse=True)
+        self.RE = re.compile(r'\b' + trie_regex(self.keywords) + r'\w+\b')
+
+    def finditer(self, text):
+        # yields (inflected word, keyword, position in text)
+        for match in self.RE.finditer(text):
+            word = match.group()
+            for n in self.lengths:
+                if n < len(word) and word[:n] in self.keywords:
+                    yield word, word[:n], match.start()
+                    break
+
+    def findall(self, text):
+        return [word for (word, keyword, start) in self.finditer(text)]
+
+matcher = KeywordMatcher(motion_verbs)
+matcher.findall(text4)
+# Returns: ['scurrying', 'walked', 'moseyed']
+# (the same words as inflected_verbs, but in the order they appear in the text)
+
+list(matcher.finditer(text4))
+# Returns: [('scurrying', 'scurry', 10), ('walked', 'walk', 37), ('moseyed', 'mosey', 52)]
+
+
+### >>> 2.8. Catastrophic backtracking <<<
+# When a search fails, the re module goes back and tries every other way the
+# quantifiers could have divided up the text. Usually there are only a few ways, but
+# if a quantifier sits inside another quantifier, or two alternatives can match the
+# same character, the number of ways doubles with every extra character:
+
+re.search(r'(\w+\s?)+$', 'the quick brown fox jumps over the lazy dog')   # fast, matches
+# re.search(r'(\w+\s?)+$', 'thequickbrownfoxjumpsoverthelazydog!')       # runs for minutes!
+
+# The patterns used above are fine: in \w+(-\w+)* every repetition of the group has
+# to start with "-", which \w+ can never match, so there is only one way to divide the
+# text. The functions below look for the bad cases in a pattern before we use it.
+
+import time
+from multiprocessing import Pool, TimeoutError
+
+try:
+    import re._parser as sre_parse   # Python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# the characters we try out when comparing what two parts of a pattern can match
+PROBE_CHARS = string.printable + u'\xe9\u4620'
+
+_CATEGORIES = {'DIGIT': r'\d', 'NOT_DIGIT': r'\D', 'SPACE': r'\s', 'NOT_SPACE': r'\S',
+               'WORD': r'\w', 'NOT_WORD': r'\W'}
+
+_REPEATS = [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT]
+_ZERO_WIDTH = [sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT]
+# Python 3.11+ also has (?>...) and *+, which never backtrack
+_POSSESSIVE = [getattr(sre_parse, 'POSSESSIVE_REPEAT', None)]
+_ATOMIC = [getattr(sre_parse, 'ATOMIC_GROUP', None)]
+
+def _class_chars(items):
+    # the probe characters matched by a [...] class
+    chars, negate = set(), False
+    for op, av in items:
+        if op == sre_parse.NEGATE:
+            negate = True
+        elif op == sre_parse.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_parse.RANGE:
+            chars.update(c for c in PROBE_CHARS if av[0] <= ord(c) <= av[1])
+        elif op == sre_parse.CATEGORY:
+            name = str(av).upper().replace('CATEGORY_', '')
+            RE = re.compile(_CATEGORIES.get(name, r'[\s\S]'), re.U)
+            chars.update(c for c in PROBE_CHARS if RE.match(c))
+    if negate:
+        return set(PROBE_CHARS) - chars
+    return chars
+
+def _children(op, av):
+    # the sub-patterns inside a group, repeat, alternation or assertion
+    if op == sre_parse.SUBPATTERN:
+        return [av[-1]]
+    if op in _REPEATS or op in _POSSESSIVE:
+        return [av[2]]
+    if op in _ATOMIC:
+        return [av]
+    if op == sre_parse.BRANCH:
+        return av[1]
+    if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [av[1]]
+    return []
+
+def _info(items):
+    # returns (characters it can start with, characters it can match, can it match '')
+    first, chars, nullable = set(), set(), True
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            f = c = set([unichr(av)])
+            n = False
+        elif op == sre_parse.NOT_LITERAL:
+            f = c = set(PROBE_CHARS) - set([unichr(av)])
+            n = False
+        elif op == sre_parse.ANY:
+            f = c = set(PROBE_CHARS) - set('\n')
+            n = False
+        elif op == sre_parse.IN:
+            f = c = _class_chars(av)
+            n = False
+        elif op in _ZERO_WIDTH:
+            f, c, n = set(), set(), True   # these don't use up any characters
+        elif op == sre_parse.BRANCH:
+            f, c, n = set(), set(), False
+            for branch in av[1]:
+                bf, bc, bn = _info(branch)
+                f, c, n = f | bf, c | bc, n or bn
+        elif _children(op, av):
+            f, c, n = _info(_children(op, av)[0])
+            if op in _REPEATS or op in _POSSESSIVE:
+                n = n or av[0] == 0
+        else:   # back-references etc.: could be anything
+            f, c, n = set(PROBE_CHARS), set(PROBE_CHARS), True
+        if nullable:
+            first |= f
+        chars |= c
+        nullable = nullable and n
+    return first, chars, nullable
+
+def _is_repeat(op, av):
+    return op in _REPEATS and av[1] > 1    # MAXREPEAT counts as > 1
+
+def _inner_repeats(items):
+    # the bodies of all repeats somewhere inside items (except in atomic groups)
+    for op, av in items:
+        if op in _ATOMIC or op in _POSSESSIVE:
+            continue
+        if _is_repeat(op, av):
+            yield av[2]
+        for sub in _children(op, av):
+            for body in _inner_repeats(sub):
+                yield body
+
+def _branches(items):
+    # the alternatives of a | at the top of items (also inside plain groups)
+    for op, av in items:
+        if op == sre_parse.BRANCH:
+            yield av[1]
+        elif op == sre_parse.SUBPATTERN:
+            for branches in _branches(av[-1]):
+                yield branches
+
+def _sample(items):
+    # a short string matched by items (used to reach the risky part of a pattern)
+    text = ''
+    for op, av in items:
+        if op in _REPEATS or op in _POSSESSIVE:
+            text += _sample(av[2]) * av[0]
+        elif op == sre_parse.BRANCH:
+            text += _sample(av[1][0])
+        elif _children(op, av) and op not in _ZERO_WIDTH:
+            text += _sample(_children(op, av)[0])
+        elif op not in _ZERO_WIDTH:
+            first = _info([(op, av)])[0]
+            text += _pick(first) if first else ''
+    return text
+
+def _pick(chars):
+    # prefer letters, which are easiest to read in the adversarial inputs
+    return min(chars, key=lambda c: (not c.islower(), not c.isalpha(), c))
+
+def find_backtracking(pattern):
+    # returns a list of (kind, description, prefix, pump) for the risky parts of the pattern,
+    # where kind is 'exponential' or 'polynomial', and prefix + pump * n reaches the risky part
+    if hasattr(pattern, 'pattern'):
+        pattern = pattern.pattern
+    problems = []
+
+    def walk(items, prefix):
+        for i, (op, av) in enumerate(items):
+            if _is_repeat(op, av):
+                body_first, body_chars = _info(av[2])[:2]
+                # 1. a repeat inside a repeat, and both can take the same character
+                for inner in _inner_repeats(av[2]):
+                    overlap = _info(inner)[1] & body_first
+                    if overlap:
+                        problems.append(('exponential', 'nested quantifiers',
+                                         prefix, _pick(overlap)))
+                        break
+                # 2. two alternatives inside a repeat can start with the same character
+                for branches in _branches(av[2]):
+                    firsts = [_info(branch)[0] for branch in branches]
+                    overlap, pump = set(), ''
+                    for j in range(len(firsts)):
+                        for m in range(j + 1, len(firsts)):
+                            if firsts[j] & firsts[m]:
+                                overlap |= firsts[j] & firsts[m]
+                                for sample in (_sample(branches[j]), _sample(branches[m])):
+                                    if len(sample) > len(pump):
+                                        pump = sample
+                    if overlap:
+                        # repeat the longest of those alternatives (e.g. 'ab' in (a|ab|b)),
+                        # which the others can split up in another way; if they are all one
+                        # character long, repeat a character that they all match
+                        if len(pump) < 2:
+                            pump = _pick(overlap)
+                        problems.append(('exponential', 'overlapping alternatives '
+                                         'inside a quantifier', prefix, pump))
+                # 3. the next repeat can take what this repeat took
+                for next_op, next_av in items[i+1:]:
+                    if _is_repeat(next_op, next_av):
+                        overlap = body_chars & _info(next_av[2])[0]
+                        if overlap:
+                            problems.append(('polynomial', 'adjacent quantifiers',
+                                             prefix, _pick(overlap)))
+                        break
+                    if not _info([(next_op, next_av)])[2]:
+                        break
+            if op not in _ATOMIC and op not in _POSSESSIVE:
+                for sub in _children(op, av):
+                    walk(sub, prefix)
+            prefix += _sample([(op, av)])
+
+    walk(list(sre_parse.parse(pattern)), '')
+    return problems
+
+find_backtracking(r'(\w+\s?)+$')
+# Returns: [('exponential', 'nested quantifiers', '', 'a')]
+find_backtracking(r'(a|ab|b)*c')
+# Returns: [('exponential', 'overlapping alternatives inside a quantifier', '', 'ab')]
+find_backtracking(r'\d+\d*x')
+# Returns: [('polynomial', 'adjacent quantifiers', '', '0')]
+find_backtracking(r'.+"'), find_backtracking(r'(([md]a)+)'), find_backtracking(r'\w+(-\w+)*')
+# Returns: ([], [], [])
+
+## >> 2.8.1. Running a pattern with a time limit <<
+# The re module can't be stopped once it starts (not even with Ctrl-C), so a guarded
+# search runs in a separate worker process, which is killed if it takes too long.
+# The results are the same as re.findall() and re.search():
+
+class RegexTimeout(Exception):
+    pass
+
+def _guarded_call(pattern, flags, method, text):
+    match = getattr(re.compile(pattern, flags), method)(text)
+    if method == 'search':   # match objects can't be sent between processes
+        return match and (match.span(), match.group(), match.groups())
+    return match
+
+class GuardedMatch(object):
+
+    def __init__(self, span, group, groups):
+        self.span_, self.group_, self.groups_ = span, group, groups
+
+    def span(self):
+        return self.span_
+
+    def start(self):
+        return self.span_[0]
+
+    def end(self):
+        return self.span_[1]
+
+    def group(self, n=0):
+        return self.group_ if n == 0 else self.groups_[n-1]
+
+    def groups(self):
+        return self.groups_
+
+class GuardedRegex(object):
+
+    def __init__(self, pattern, flags=0, timeout=1.0):
+        self.RE = re.compile(pattern, flags)
+        self.timeout = timeout    # in seconds
+        self.pool = None
+
+    def _run(self, method, text):
+        if self.pool is None:
+            self.pool = Pool(1)
+        result = self.pool.apply_async(_guarded_call,
+                                       (self.RE.pattern, self.RE.flags, method, text))
+        try:
+            return result.get(self.timeout)
+        except TimeoutError:
+            self.pool.terminate()   # the only way to stop the search
+            self.pool = None
+            raise RegexTimeout('%r took more than %s seconds on a string of length %d'
+                               % (self.RE.pattern, self.timeout, len(text)))
+
+    def findall(self, text):
+        return self._run('findall', text)
+
+    def search(self, text):
+        found = self._run('search', text)
+        return found and GuardedMatch(*found)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+guarded = GuardedRegex(r'\w+(-\w+)*', timeout=1.0)
+guarded.search('a well-known fact').group()
+# Returns: 'a'
+guarded.findall('a well-known fact')
+# Returns: ['', '-known', '']
+
+guarded = GuardedRegex(r'(\w+\s?)+$', timeout=1.0)
+# guarded.search('thequickbrownfoxjumpsoverthelazydog!')
+# Raises: RegexTimeout: '(\\w+\\s?)+$' took more than 1.0 seconds on a string of length 36
+guarded.close()
+
+## >> 2.8.2. Timing a pattern on adversarial inputs <<
+# For every problem found, we build strings that force the most backtracking: the
+# repeated character, followed by a character that makes the whole search fail.
+# If the time doubles with every few extra characters, the pattern is exponential:
+
+def adversarial_inputs(pattern, n):
+    # returns a list of (kind, text) for every problem found in the pattern
+    inputs = []
+    for kind, description, prefix, pump in find_backtracking(pattern):
+        for end in '!\n\x00-_ a0':
+            if end != pump:
+                inputs.append((kind, prefix + pump * n + end))
+    return inputs
+
+def time_pattern(pattern, sizes=(10, 14, 18, 22, 26), timeout=1.0):
+    # returns a list of (length of the slowest input, its time in seconds); None means timed out
+    timings = []
+    if not find_backtracking(pattern):
+        return timings
+    guarded = GuardedRegex(pattern, timeout=timeout)
+    try:
+        for n in sizes:
+            slowest, length = 0.0, 0
+            for kind, text in adversarial_inputs(pattern, n):
+                start = time.time()
+                try:
+                    guarded.search(text)
+                except RegexTimeout:
+                    slowest, length = None, len(text)
+                    break
+                seconds = time.time() - start
+                if seconds >= slowest:
+                    slowest, length = seconds, len(text)
+            timings.append((length, slowest))
+            if slowest is None:
+                break
+    finally:
+        guarded.close()
+    return timings
+
+time_pattern(r'(\w+\s?)+$')
+# Returns (depends on the computer): [(11, 0.006), (15, 0.009), (19, 0.07), (23, None)]
+time_pattern(r'\w+(-\w+)*')
+# Returns: [] (nothing to worry about)
+
 
 ##### >>>>> 3. REFERENCES AND TOOLS <<<<<
 